@@ -2,7 +2,8 @@
 Analysis_by_esn.py is similar to network_analysis.py. However, it differs in that the
 polygons produced (in the outputted geoJson files) are bounded by the Fire Department
 Emergency Service Zones. It produces these by intersecting the polygons produced by
-network_analysis.py with the Fire Dept. Emergency Service Zones polygons.
+network_analysis.py with the Fire Dept. Emergency Service Zones polygons: every
+polygon is joined to its zone by FIRE_AgencyId and all of them are intersected at once.
 The geometries of these zones is collected from the VT Open Geodata Portal:
 https://geodata.vermont.gov/datasets/vt-data-e911-emergency-service-zones
 
@@ -13,114 +14,105 @@ In total, the following files are output by this script:
 - 20_esn.geojson
 - esn_zones.geojson –> contains the Emergency Service Zones polygons, to be displayed on the website.
 
+Running this script on its own reads the files written by network_analysis.py. The same
+files can also be produced directly by network_analysis.py --esn, which bounds the
+polygons in memory as they are computed (using the functions below).
+
 Based on code from https://towardsdatascience.com/how-to-calculate-travel-time-for-any-location-in-the-world-56ce639511f
 and https://github.com/gboeing/osmnx-examples/blob/7cb65dbd64b5923a6013a94b72585f27d7a0acfa/notebooks/13-isolines-isochrones.ipynb
 
 Authors: Halcyon Brown & John Cambefort
 """
 
-import osmnx as ox
+import pandas as pd
 import geopandas as gpd
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+from shapely.validation import make_valid
 from tqdm import tqdm
-from network_analysis import RESPONSE_TIMES
-
-ox.config(log_console=False,
-            use_cache=True,
-            bidirectional_network_types=['drive_service'])
-
-# Returns a response polygon (dataframe) that is bounded by its corresponding emergency service zone
-def intersect_polygons(zone_polygon, response_polygon, agency_id, response_time):
-    zone_series = gpd.GeoSeries(zone_polygon, crs=3395)
-    zone_as_gdf = gpd.GeoDataFrame([zone_series])
-    # Rename the geometry column appropriately
-    zone_as_gdf.columns = ['geometry']
-
-    response_series = gpd.GeoSeries(response_polygon, crs=3395)
-    response_as_gdf = gpd.GeoDataFrame([response_series])
-    # Rename the geometry column appropriately
-    response_as_gdf.columns = ['geometry']
-    
-    # Perform the intersection
-    join = gpd.overlay(response_as_gdf, zone_as_gdf, how="intersection")
-    join.crs = "EPSG:3395"
-    # Add the response time column
-    join['response_time'] = response_time
-
-    # Add the agency id column
-    join['FIRE_AgencyId'] = agency_id
-    
-    # Return the dataframe containing the cookie-cutter response polygon
-    join.to_crs(crs=3395)
-    join.to_crs("EPSG:4326")
-    return join
-
-
-########################################
-
-if __name__ == "__main__":
+from geojson_io import GeoJSONWriter
+from config import RESPONSE_TIMES
+from manifest import stage_is_current, record_stage
+from intermediates import intermediate_path, read_intermediate
+
+# Returns the polygonal part of a geometry (intersections and repairs can also produce
+# points or lines where two polygons only touch), an empty Polygon for missing geometries
+def polygonal_part(geometry):
+    if geometry is None:
+        return Polygon()
+    if geometry.geom_type in ["Polygon", "MultiPolygon"]:
+        return geometry
+    polygons = [part for part in getattr(geometry, "geoms", []) if part.geom_type in ["Polygon", "MultiPolygon"]]
+    return unary_union(polygons) if polygons else Polygon()
+
+
+# Returns the dissolved FIRE_AgencyId zones, with invalid zone polygons repaired.
+# This is done once up front so that every response polygon can be clipped in bulk.
+def prepare_zones(zone_polygons):
+    # Dissolve the ESN polygons into the wider FIRE_AgencyId zones
+    zones = zone_polygons.dissolve(by="FIRE_AgencyId").reset_index()
+
+    # Repair the invalid zone polygons (e.g. self-intersecting rings)
+    invalid = ~zones.is_valid
+    if invalid.any():
+        print("Repairing invalid zone polygons: %s" % list(zones.loc[invalid, "FIRE_AgencyId"]))
+        zones.loc[invalid, "geometry"] = zones.loc[invalid, "geometry"].apply(
+            lambda zone: polygonal_part(make_valid(zone)))
+    return zones
+
+
+# Returns the response polygons (GeoDataFrame with "response_time", "FIRE_AgencyId" and
+# "geometry" columns) bounded by their corresponding emergency service zone.
+# All the polygons are joined to their zone by FIRE_AgencyId and intersected at once.
+# Missing and empty polygons (written as null geometries by GeoJSONWriter) are dropped.
+def clip_to_zones(response_gdf, zones):
+    response_gdf = response_gdf[~response_gdf.geometry.isna() & ~response_gdf.is_empty]
+    zone_geometries = zones[["FIRE_AgencyId", "geometry"]].rename(columns={"geometry": "zone_geometry"})
+    joined = pd.DataFrame(response_gdf[["response_time", "FIRE_AgencyId", "geometry"]]).merge(
+        zone_geometries, on="FIRE_AgencyId", how="inner")
+
+    # Intersect the aligned response and zone geometry arrays
+    clipped = gpd.GeoSeries(joined["geometry"]).intersection(gpd.GeoSeries(joined["zone_geometry"]))
+    clipped = clipped.apply(polygonal_part)
+
+    bounded = gpd.GeoDataFrame({"response_time": joined["response_time"],
+        "FIRE_AgencyId": joined["FIRE_AgencyId"], "geometry": clipped}, crs=response_gdf.crs)
+    return bounded[~bounded.is_empty]
+
+
+# Runs this stage (also called in-process by pipeline.py)
+def main():
+    # Skip this stage if the polygons and zones did not change since the last run
+    stage_inputs = ["data/%d.geojson" % (time / 60) for time in RESPONSE_TIMES] + [
+        intermediate_path("zone_polygons"), "analysis_by_esn.py", "geojson_io.py", "config.py"]
+    if stage_is_current("analysis_by_esn", stage_inputs):
+        print("Response polygons and zones are unchanged, skipping")
+        return
 
     # Read in the emergency service zones to be used for subgraphs  
-    zone_polygons = gpd.read_file("data/zone_polygons.geojson")
+    zone_polygons = read_intermediate("zone_polygons")
 
-    # Dissolve the ESN polygons into the wider FIRE_AgencyId zones
-    zone_polygons = zone_polygons.dissolve(by = "FIRE_AgencyId").reset_index()
+    # Dissolve the ESN polygons into the wider FIRE_AgencyId zones and repair them
+    zone_polygons = prepare_zones(zone_polygons)
 
     # Output the ESN polygons to a geoJson, to be displayed on the website
     zone_polygons.to_file("data/esn_zones.geojson", driver = "GeoJSON")
-    
-    # initialize array to hold state-bounded-polygon geojson files
-    response_polygons = []
 
     # Read in each of the response time geojson files 
-    for time in RESPONSE_TIMES: # use the response time values in network_analysis.py
-        response_time_gdf = gpd.read_file("data/%d.geojson" % (time / 60))
-        response_polygons.append(response_time_gdf)
-    
-    # Initialize list that will hold the outputted dataframes with ESN polygons
-    gdf_list = []
-
-    # Initialize as many GeoDataFrames as there are response time bins
-    # Store these new GeoDataFrames in the gdf_list array.
-    for i in range(len(RESPONSE_TIMES)):
-        gdf_list.append(gpd.GeoDataFrame())
-
-    invalid_zone_polygons = []
-
-    # Iterate over the response_geojson dataframes 
-    for i in range(len(response_polygons)):
-        response_dataframe = response_polygons[i]
-        # Iterate over polygons in the dataframe
-        # For each polygon, intersect it with its corresponding service zone based on Fire_AgencyId
-        # Then add the new polygon to a new esn_based response time geojson
-
-        for j in tqdm(range(len(response_dataframe))):
-            response_polygon_geometry = response_dataframe['geometry'].loc[j]
-            response_polygon_id = response_dataframe['FIRE_AgencyId'].loc[j]
-            response_polygon_time = response_dataframe['response_time'].loc[j]
-            # Locate the corresponding zone
-            zone_coords = zone_polygons.loc[zone_polygons["FIRE_AgencyId"] == response_polygon_id, ["FIRE_AgencyId", "ESN", "geometry"]]
-            #print(zone_coords)
-            zone_poly = zone_coords["geometry"].iloc[0]
-
-            # Double check that the zone polygon is valid
-            if not(zone_poly.is_valid):
-                invalid_zone_polygons.append(response_polygon_id)
-                continue
-            else:
-                # Returns a GeoDataFrame with columns "response_time", "Agency Id" and "geometry"
-                # where the geometry column contains the response time polygons
-                bounded_response_poly = intersect_polygons(zone_poly, response_polygon_geometry, response_polygon_id, response_polygon_time)
-                # Add the polygon dataframe to corresponding dataframe in gdf_list
-
-                # Filter through rows in station_gdf by response_time and append to corresponding GeoDataFrame()
-                for j in range(len(response_polygons)):
-                    row = bounded_response_poly.loc[
-                        (bounded_response_poly['response_time'] == RESPONSE_TIMES[j]), 
-                        ['response_time', 'FIRE_AgencyId', 'geometry']
-                    ]
-                    gdf_list[j] = gdf_list[j].append(row)
-
-    # Convert each of the response time GeoDataFrames to geoJson files to be read by Leaflet
-    for i in range(len(gdf_list)):
-        response_min = int(RESPONSE_TIMES[i]/60)
-        gdf_list[i].to_file("data/%s_esn.geojson" % str(response_min), driver="GeoJSON")
\ No newline at end of file
+    for time in tqdm(RESPONSE_TIMES): # use the response time values in config.py
+        response_gdf = gpd.read_file("data/%d.geojson" % (time / 60))
+
+        # Bound every polygon of the file by its service zone
+        bounded_gdf = clip_to_zones(response_gdf, zone_polygons)
+
+        # Convert the bounded GeoDataFrame to a geoJson file to be read by Leaflet
+        with GeoJSONWriter("data/%d_esn.geojson" % (time / 60)) as writer:
+            writer.write_frame(bounded_gdf, ["response_time", "FIRE_AgencyId"])
+
+    record_stage("analysis_by_esn", stage_inputs,
+        ["data/%d_esn.geojson" % (time / 60) for time in RESPONSE_TIMES] + ["data/esn_zones.geojson"])
+
+########################################
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+"""
+Config.py holds the settings shared by several stages of the pipeline, so that they
+can be imported without pulling in the heavy dependencies of the stage that uses them
+(e.g. analysis_by_esn.py does not need osmnx to know the response time bins).
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+# Response time bins to used for the network analysis (values in seconds)
+# Bins are all derived from a single shortest-path search per station, so adding
+# a bin (e.g. 900 or 1800) only adds the cost of building its polygon.
+RESPONSE_TIMES = [120, 300, 600, 1200]
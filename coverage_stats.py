@@ -0,0 +1,136 @@
+"""
+Coverage_stats.py counts how many E911 site structures (homes, businesses, ...) are
+covered by the response time polygons and by the hydrant buffers, per fire agency and
+per town.
+
+Every structure is tested against the following layers:
+- 2.geojson, 5.geojson, ... (statewide response time polygons, see network_analysis.py)
+- 2_esn.geojson, 5_esn.geojson, ... (polygons bounded by the Emergency Service Zones)
+- Dry_Hydrant_buffers.geojson, ... (hydrant buffers, or their dissolved Dry_Hydrant_coverage.geojson,
+  see hydrant_analysis.py)
+Layers that have not been generated are skipped.
+
+The polygons of every layer are loaded into an STRtree spatial index, which is queried
+with all the structure points at once, so the cost grows with the number of actual
+point/polygon matches rather than with the number of structures times the number of polygons.
+
+This module outputs the following files:
+- coverage_by_agency.csv / coverage_by_agency.json (one row per FIRE_AgencyId)
+- coverage_by_town.csv / coverage_by_town.json (one row per town)
+Every row holds the number of structures, and for every layer the number and the
+percentage of structures it covers.
+
+It takes as input the structures file downloaded by datasets.py and the zone_polygons
+intermediate file written by produce_geojson.py (used to find the FIRE_AgencyId of every structure's ESN).
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import STRtree
+from config import RESPONSE_TIMES
+from datasets import API_STRUCTURES_PATH
+from intermediates import read_intermediate
+
+# Hydrant types for which a buffer layer is written by hydrant_analysis.py
+HYDRANT_TYPES = ['Dry Hydrant', 'Drafting Site', 'Municipal Hydrant', 'Pressurized Hydrant', 'Unknown Type']
+
+# Columns the structures are grouped by, and the name of the corresponding output files
+GROUPINGS = {"FIRE_AgencyId": "coverage_by_agency", "TOWNNAME": "coverage_by_town"}
+
+
+# Returns the coverage layers to test the structures against, as a dictionary of
+# layer name -> path of the geoJson file, keeping only the files that exist
+def coverage_layers(data_path="data"):
+    layers = {}
+    for response_time in RESPONSE_TIMES:
+        minutes = str(int(response_time/60))
+        layers["%s_min" % minutes] = os.path.join(data_path, "%s.geojson" % minutes)
+        layers["%s_min_esn" % minutes] = os.path.join(data_path, "%s_esn.geojson" % minutes)
+    for hydrant_type in HYDRANT_TYPES:
+        file_name = hydrant_type.replace(" ", "_")
+        layers[file_name] = os.path.join(data_path, "%s_buffers.geojson" % file_name)
+        # Use the dissolved coverage written by hydrant_analysis.py --dissolve otherwise
+        if not os.path.exists(layers[file_name]):
+            layers[file_name] = os.path.join(data_path, "%s_coverage.geojson" % file_name)
+    return {name: path for name, path in layers.items() if os.path.exists(path)}
+
+
+# Returns a boolean array telling which points are covered by at least one of the
+# given polygons. All the points are queried against an STRtree of the polygons at once.
+def covered_points(points, polygons):
+    polygons = polygons[~(polygons.isna() | polygons.is_empty)]
+    covered = np.zeros(len(points), dtype=bool)
+    if len(polygons) == 0:
+        return covered
+    tree = STRtree(polygons.values)
+    point_indices, _ = tree.query(points.values, predicate="intersects")
+    covered[point_indices] = True
+    return covered
+
+
+# Returns the structures (GeoDataFrame in lon/lat) with the FIRE_AgencyId of their ESN
+def read_structures(structures_path, zone_polygons):
+    structures = gpd.read_file(structures_path)[["TOWNNAME", "ESN", "geometry"]]
+    structures = structures[~(structures['geometry'].isna() | structures['geometry'].is_empty)]
+    structures = structures.to_crs("EPSG:4326")
+
+    # Every ESN belongs to a single FIRE_AgencyId
+    agencies = zone_polygons[["ESN", "FIRE_AgencyId"]].drop_duplicates("ESN")
+    structures = structures.merge(agencies, on="ESN", how="left")
+    structures["FIRE_AgencyId"] = structures["FIRE_AgencyId"].fillna("UNKNOWN")
+    structures["TOWNNAME"] = structures["TOWNNAME"].fillna("UNKNOWN")
+    return structures.reset_index(drop=True)
+
+
+# Returns a DataFrame with one boolean column per layer, telling which structures it covers
+def structure_coverage(structures, layers):
+    coverage = pd.DataFrame(index=structures.index)
+    for name, path in layers.items():
+        print("Testing structures against %s..." % name)
+        polygons = gpd.read_file(path).to_crs("EPSG:4326")['geometry']
+        coverage[name] = covered_points(structures['geometry'], polygons)
+
+    # Structures covered by a hydrant buffer of any type
+    hydrant_layers = [name for name in coverage.columns if name in
+        [hydrant_type.replace(" ", "_") for hydrant_type in HYDRANT_TYPES]]
+    if hydrant_layers:
+        coverage["any_hydrant"] = coverage[hydrant_layers].any(axis=1)
+    return coverage
+
+
+# Returns the number of structures per group, and for every layer the number and
+# percentage of them that are covered
+def coverage_table(structures, coverage, group_column):
+    groups = structures[group_column].values
+    counts = coverage.groupby(groups).sum().astype(int)
+    table = pd.DataFrame({"structures": coverage.groupby(groups).size()})
+    for name in coverage.columns:
+        table["%s_count" % name] = counts[name]
+        table["%s_pct" % name] = (100 * counts[name] / table["structures"]).round(1)
+    table.index.name = group_column
+    return table.reset_index()
+
+
+# Runs this stage (also called in-process by pipeline.py)
+def main():
+    # Read in the structures and the zones used to match them to their fire agency
+    zone_polygons = read_intermediate("zone_polygons")
+    structures = read_structures(API_STRUCTURES_PATH, zone_polygons)
+    print("%d structures" % len(structures))
+
+    coverage = structure_coverage(structures, coverage_layers())
+
+    for group_column, file_name in GROUPINGS.items():
+        table = coverage_table(structures, coverage, group_column)
+        print("Outputting %s.csv and %s.json..." % (file_name, file_name))
+        table.to_csv("data/%s.csv" % file_name, index=False)
+        table.to_json("data/%s.json" % file_name, orient="records", indent=1)
+
+########################################
+
+if __name__ == "__main__":
+    main()
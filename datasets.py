@@ -4,68 +4,142 @@ to download the E911 Fire Hydrants, E911 Emergency Service Zones,
 E911 Site Structures (which includes fire stations) and Vermont State geometry
 datasets as .json files.  Each of these datasets includes a geometry column.
 
-These files are ingested by produce_geojson.py which parses and filters the data 
+The four datasets are downloaded concurrently (one thread each), and every response
+body is streamed to disk in chunks instead of being loaded in memory, so the download
+takes as long as the slowest dataset and uses little memory. Failed or incomplete
+downloads (e.g. fewer bytes than announced by the server) are retried.
+
+The requests are conditional: the ETag / Last-Modified validators of the previous download
+are recorded in the pipeline manifest (see manifest.py), and a dataset that has not changed
+on the portal since then is not downloaded again.
+
+These files are ingested by produce_geojson.py which parses and filters the data
 to preserve only required information (e.g. Fire Department info).
 
 Authors: Halcyon Brown & John Cambefort
 """
 
 import os
+import time
 import requests
-import json
+from concurrent.futures import ThreadPoolExecutor
+from manifest import download_validators, record_download
 
 API_HYDRANTS_PATH = "data/hydrants.json"
 API_ZONES_PATH = "data/zones.json"
 API_STRUCTURES_PATH = "data/structures.json"
 API_VERMONT_PATH = "data/vermont.json"
 
-# Downloads data as JSON files from the Vermont Geoportal REST API
-def request_API_data():
-
-    # Make the request for E-911 hydrant data from VT Geoportal
-    r = requests.get('https://opendata.arcgis.com/datasets/faa4109d4a504dcfbe3b6af6f752fbb7_0.geojson')
-    if not(r.raise_for_status()):
-        # Create the json object
-        hydrant_data = r.json()
-        # Write the object to file.
-        with open(API_HYDRANTS_PATH,'w') as jsonFile:
-            json.dump(hydrant_data, jsonFile)
-    else:
-        print("An error occurred while trying to retrieve hydrant data")
-        exit(1) # Exit to warn maintainers of an error related to the API
-
-    # make the request for E-911 service zone data from VT Geoportal
-    r = requests.get('https://opendata.arcgis.com/datasets/2fcd8223c02b450f8ef12218c4bb1917_0.geojson')
-    if not(r.raise_for_status()):
-        # Create the json object
-        zone_data = r.json()
-        # Write the object to file.
-        with open(API_ZONES_PATH,'w') as jsonFile:
-            json.dump(zone_data, jsonFile)
-    else:
-        print("An error occurred while trying to retrieve service zone data")
-        exit(1) # Exit to warn maintainers of an error related to the API
-
-    # make the request for E-911 structure data from VT Geoportal
-    r = requests.get('https://opendata.arcgis.com/datasets/b226846d719a4b3fa59485a41aed1ddf_0.geojson')
-    if not(r.raise_for_status()): 
-        # Create the json object
-        structures_data = r.json()
-        # Write the object to file.
-        with open(API_STRUCTURES_PATH,'w') as jsonFile:
-            json.dump(structures_data, jsonFile)
-    else:
-        print("An error occurred while trying to retrieve structure data")
-        exit(1) # Exit to warn maintainers of an error related to the API
-
-    # make the request for state of Vermont polygon from VT Geoportal
-    r = requests.get('https://opendata.arcgis.com/datasets/444912c91fc94ab0a8b47781d7b147bb_0.geojson')
-    if not(r.raise_for_status()): 
-        # Create the json object
-        vermont_state_data = r.json()
-        # Write the object to file.
-        with open(API_VERMONT_PATH,'w') as jsonFile:
-            json.dump(vermont_state_data, jsonFile)
-    else:
-        print("An error occurred while trying to retrieve Vermont state data")
-        exit(1) # Exit to warn maintainers of an error related to the API
\ No newline at end of file
+# Datasets to download: name -> (url, output path)
+DATASETS = {
+    "hydrant": ('https://opendata.arcgis.com/datasets/faa4109d4a504dcfbe3b6af6f752fbb7_0.geojson', API_HYDRANTS_PATH),
+    "service zone": ('https://opendata.arcgis.com/datasets/2fcd8223c02b450f8ef12218c4bb1917_0.geojson', API_ZONES_PATH),
+    "structure": ('https://opendata.arcgis.com/datasets/b226846d719a4b3fa59485a41aed1ddf_0.geojson', API_STRUCTURES_PATH),
+    "Vermont state": ('https://opendata.arcgis.com/datasets/444912c91fc94ab0a8b47781d7b147bb_0.geojson', API_VERMONT_PATH),
+}
+
+# Timeouts (in seconds) to connect to the server and between two chunks of the response
+DOWNLOAD_TIMEOUT = (10, 120)
+
+# Number of attempts per dataset, and delay (in seconds) before the first retry
+# (doubled after every failed attempt)
+DOWNLOAD_ATTEMPTS = 3
+RETRY_DELAY = 5
+
+# Size (in bytes) of the chunks written to disk
+CHUNK_SIZE = 1 << 20
+
+
+# Raised when a dataset could not be downloaded completely
+class DownloadError(Exception):
+    pass
+
+
+# Returns whether a downloaded file looks like a complete JSON object (starts with "{" and
+# ends with "}"), without parsing it. Truncated downloads fail this check.
+def is_complete_json(path):
+    with open(path, 'rb') as jsonFile:
+        head = jsonFile.read(64).lstrip()
+        jsonFile.seek(max(os.path.getsize(path) - 64, 0))
+        tail = jsonFile.read().rstrip()
+    return head.startswith(b"{") and tail.endswith(b"}")
+
+
+# Returns the headers making a request conditional on the file having changed since it
+# was downloaded with the given validators (if the file is still there)
+def conditional_headers(path, validators):
+    headers = {}
+    if os.path.exists(path):
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+# Downloads the response body of a url to a file in chunks. The body is written to a
+# temporary file that only replaces the output file once it has been checked:
+# its size must match the Content-Length header (when sent), and it must look like
+# complete JSON if check_json is set.
+# Given the validators of the previous download, the file is left as is if the server
+# reports it has not changed. Returns the validators of the downloaded file.
+def download_file(url, path, timeout=DOWNLOAD_TIMEOUT, chunk_size=CHUNK_SIZE, check_json=True,
+        validators=None):
+    tmp_path = path + ".tmp"
+    validators = validators or {}
+    headers = conditional_headers(path, validators)
+    with requests.get(url, stream=True, timeout=timeout, headers=headers) as r:
+        if r.status_code == 304:
+            print("%s is unchanged" % path)
+            return validators
+        r.raise_for_status()
+        new_validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        size = 0
+        with open(tmp_path, 'wb') as outFile:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                outFile.write(chunk)
+                size += len(chunk)
+
+        # The Content-Length is the size of the body as sent, which differs from the
+        # decoded size when the server compresses it
+        expected = r.headers.get("Content-Length")
+        if expected is not None and "Content-Encoding" not in r.headers and size != int(expected):
+            os.remove(tmp_path)
+            raise DownloadError("received %d of %s bytes from %s" % (size, expected, url))
+
+    if check_json and not is_complete_json(tmp_path):
+        os.remove(tmp_path)
+        raise DownloadError("incomplete JSON received from %s" % url)
+    os.replace(tmp_path, path)
+    return new_validators
+
+
+# Downloads a url to a file (see download_file), retrying failed attempts, and records
+# the validators and content hash of the file in the manifest
+def download_with_retries(url, path, attempts=DOWNLOAD_ATTEMPTS, retry_delay=RETRY_DELAY, **kwargs):
+    validators = download_validators(path)
+    for attempt in range(attempts):
+        try:
+            validators = download_file(url, path, validators=validators, **kwargs)
+            break
+        except (requests.RequestException, DownloadError) as error:
+            if attempt == attempts - 1:
+                raise
+            print("Download of %s failed (%s), retrying..." % (url, error))
+            time.sleep(retry_delay * 2 ** attempt)
+    record_download(path, validators)
+
+
+# Downloads data as JSON files from the Vermont Geoportal REST API.
+# All the datasets are downloaded at once, one thread each.
+def request_API_data(datasets=DATASETS, **kwargs):
+    with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+        futures = {name: executor.submit(download_with_retries, url, path, **kwargs)
+            for name, (url, path) in datasets.items()}
+
+        for name, future in futures.items():
+            try:
+                future.result()
+            except (requests.RequestException, DownloadError) as error:
+                print("An error occurred while trying to retrieve %s data: %s" % (name, error))
+                exit(1) # Exit to warn maintainers of an error related to the API
@@ -26,4 +26,6 @@ def csv_to_json(csvFilePath, jsonFilePath):
           
 csvFilePath = r'department_types.csv'
 jsonFilePath = r'data/department_types.json'
-csv_to_json(csvFilePath, jsonFilePath)
+
+if __name__ == "__main__":
+    csv_to_json(csvFilePath, jsonFilePath)
@@ -0,0 +1,183 @@
+"""
+Geojson_io.py contains a streaming GeoJSON writer used to output the layers displayed
+on the website (response time polygons, hydrant buffers, ...), and a streaming reader
+used to pick a few features out of the large raw datasets.
+
+Features are written to the file as soon as they are produced instead of being
+accumulated in a GeoDataFrame and written with GeoDataFrame.to_file(), so memory use
+stays bounded no matter how many features a layer contains. The files have the same
+structure as the ones written by GeoPandas/Fiona: a FeatureCollection whose features
+hold a `properties` object and a `geometry` object in lon/lat (EPSG:4326).
+
+Similarly, read_features() parses a FeatureCollection file one feature at a time and
+only keeps the features whose properties match a filter, so reading e.g. the few hundred
+fire stations out of the E911 structures dataset does not load the whole file in memory,
+and only the matching features are turned into shapely geometries.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import os
+import re
+import json
+import math
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import mapping, shape
+
+# Number of decimals written for the coordinates (6 decimals of a degree is ~0.1 meter)
+COORDINATE_PRECISION = 6
+
+# CRS member written at the top of every file (same as the one written by GDAL)
+GEOJSON_CRS = {"type": "name", "properties": {"name": "urn:ogc:def:crs:OGC:1.3:CRS84"}}
+
+# Size (in characters) of the blocks read from a file by iter_features()
+READ_BLOCK_SIZE = 1 << 20
+
+# Start of the features array of a FeatureCollection
+FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+
+
+# Returns the coordinates of a GeoJSON geometry rounded to `precision` decimals
+def round_coordinates(coordinates, precision):
+    if isinstance(coordinates[0], (int, float)):
+        return [round(value, precision) for value in coordinates]
+    return [round_coordinates(part, precision) for part in coordinates]
+
+
+# Returns a GeoJSON geometry dictionary for a shapely geometry
+def geometry_to_geojson(geometry, precision):
+    if geometry is None or geometry.is_empty:
+        return None
+    geojson = mapping(geometry)
+    if geojson["type"] == "GeometryCollection":
+        return {"type": "GeometryCollection",
+            "geometries": [geometry_to_geojson(part, precision) for part in geometry.geoms]}
+    return {"type": geojson["type"], "coordinates": round_coordinates(geojson["coordinates"], precision)}
+
+
+# Returns a property value that can be serialized to JSON (NumPy scalars are converted
+# to Python values, and NaN is written as null)
+def property_to_geojson(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+# Writes features one at a time to a GeoJSON FeatureCollection file.
+# Can be used as a context manager, the file is completed when the writer is closed.
+class GeoJSONWriter:
+
+    def __init__(self, path, precision=COORDINATE_PRECISION):
+        self.path = path
+        self.precision = precision
+        self.count = 0
+        # Write to a temporary file that replaces the output file once it is complete
+        self._tmp_path = path + ".tmp"
+        self._file = open(self._tmp_path, 'w')
+        name = os.path.splitext(os.path.basename(path))[0]
+        self._file.write('{"type":"FeatureCollection","name":%s,"crs":%s,"features":[\n'
+            % (json.dumps(name), json.dumps(GEOJSON_CRS, separators=(',', ':'))))
+
+    # Writes a single feature given its shapely geometry and a dictionary of properties
+    def write(self, geometry, properties):
+        feature = {
+            "type": "Feature",
+            "properties": {key: property_to_geojson(value) for key, value in properties.items()},
+            "geometry": geometry_to_geojson(geometry, self.precision),
+        }
+        if self.count > 0:
+            self._file.write(',\n')
+        self._file.write(json.dumps(feature, separators=(',', ':')))
+        self.count += 1
+
+    # Writes every row of a GeoDataFrame as a feature, with the given property columns
+    def write_frame(self, gdf, columns):
+        for geometry, values in zip(gdf['geometry'], gdf[columns].itertuples(index=False, name=None)):
+            self.write(geometry, dict(zip(columns, values)))
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.write('\n]}\n')
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Only replace the output file when the layer was written completely
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+
+# Yields the features of a GeoJSON FeatureCollection file one at a time (as dictionaries),
+# reading the file in blocks instead of loading it whole
+def iter_features(path, block_size=READ_BLOCK_SIZE):
+    decoder = json.JSONDecoder()
+    with open(path) as jsonFile:
+        # Find the start of the features array
+        buffer = ""
+        match = None
+        while match is None:
+            block = jsonFile.read(block_size)
+            if not block:
+                raise ValueError("%s is not a GeoJSON FeatureCollection" % path)
+            # Keep the end of the previous block in case the key was split between blocks
+            buffer = buffer[-64:] + block
+            match = FEATURES_START.search(buffer)
+        buffer = buffer[match.end():]
+        position = 0
+
+        while True:
+            # Skip to the next feature (or the end of the array)
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+
+            # Decode the next feature, reading more of the file while it is incomplete
+            # (the read size grows with the buffer so very large features are read quickly)
+            try:
+                if position == len(buffer):
+                    raise json.JSONDecodeError("Expecting value", buffer, position)
+                feature, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                block = jsonFile.read(max(block_size, len(buffer)))
+                if not block:
+                    raise ValueError("%s ends in the middle of its features" % path)
+                buffer = buffer[position:] + block
+                position = 0
+                continue
+            yield feature
+
+            # Drop the features that were already decoded
+            if position > block_size:
+                buffer = buffer[position:]
+                position = 0
+
+
+# Returns a GeoDataFrame (in lon/lat) of the features of a GeoJSON FeatureCollection file
+# whose properties match a filter (a function of the properties dictionary returning a
+# boolean, every feature is kept if None), with the given property columns (all of them if None).
+# The file is parsed one feature at a time, and only the matching features are turned
+# into geometries.
+def read_features(path, where=None, columns=None):
+    rows = []
+    geometries = []
+    for feature in iter_features(path):
+        properties = feature.get("properties") or {}
+        if where is not None and not where(properties):
+            continue
+        rows.append(properties if columns is None else {column: properties.get(column) for column in columns})
+        geometries.append(shape(feature["geometry"]) if feature.get("geometry") else None)
+
+    data = pd.DataFrame(rows, columns=columns)
+    return gpd.GeoDataFrame(data, geometry=gpd.GeoSeries(geometries, index=data.index), crs="EPSG:4326")
@@ -0,0 +1,99 @@
+"""
+Graph_cache.py stores the projected, speed-annotated road network graph built by
+network_analysis.make_graph() as a versioned binary cache, so that later runs do not
+need to download the graph again or parse a huge .graphml file.
+
+The cache is a directory containing one .npy file per CSRGraph array (see routing.py)
+and a meta.json file. Only the fields used by the pipeline are stored: node ids,
+projected x/y coordinates, lon/lat, the edges (CSR arrays), their travel_time and length.
+The arrays are memory-mapped when loaded, so loading takes seconds. The KD-tree used
+to snap points to the graph nodes is stored next to them (kdtree.pickle).
+
+The cache is keyed by a hash of the bounding polygon, the default highway speeds,
+the network type and the OpenStreetMap extract the graph was read from (if any, see
+osm_extract.py): if any of them changes, the cache is ignored and rebuilt.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import numpy as np
+from routing import CSRGraph
+
+# Bump this whenever the layout of the cache changes
+CACHE_VERSION = 3
+
+# CSRGraph arrays stored in the cache, one .npy file each
+CACHE_ARRAYS = ["node_ids", "x", "y", "lon", "lat", "indptr", "indices", "travel_time", "length"]
+
+
+# Returns the key identifying a graph built from the given bounding polygon,
+# highway speeds table and network type, and from the OpenStreetMap extract whose
+# content hash is given (None for a graph downloaded from the Overpass API)
+def cache_key(bounding_zone, hwy_speeds, network_type, source=None):
+    key = hashlib.sha256()
+    key.update(str(CACHE_VERSION).encode())
+    key.update(bounding_zone.wkb)
+    key.update(json.dumps(hwy_speeds, sort_keys=True).encode())
+    key.update(network_type.encode())
+    if source is not None:
+        key.update(source.encode())
+    return key.hexdigest()
+
+
+# Writes the CSRGraph to the cache directory at cache_path
+def save_graph_cache(csr_graph, cache_path, key):
+    # Write to a temporary directory first so an interrupted run never leaves
+    # a partially written cache behind
+    tmp_path = cache_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    for name in CACHE_ARRAYS:
+        np.save(os.path.join(tmp_path, name + ".npy"), getattr(csr_graph, name))
+
+    # Store the spatial index used to snap points to the graph along with it
+    with open(os.path.join(tmp_path, "kdtree.pickle"), 'wb') as treeFile:
+        pickle.dump(csr_graph.tree, treeFile, protocol=pickle.HIGHEST_PROTOCOL)
+
+    meta = {"version": CACHE_VERSION, "key": key, "crs": str(csr_graph.crs)}
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as metaFile:
+        json.dump(meta, metaFile)
+
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(tmp_path, cache_path)
+
+
+# Returns the CSRGraph stored in the cache directory at cache_path, or None if there
+# is no cache or if it was built with a different version or key
+def load_graph_cache(cache_path, key):
+    meta_path = os.path.join(cache_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as metaFile:
+        meta = json.load(metaFile)
+    if meta.get("version") != CACHE_VERSION or meta.get("key") != key:
+        return None
+
+    arrays = {name: np.load(os.path.join(cache_path, name + ".npy"), mmap_mode='r')
+        for name in CACHE_ARRAYS}
+    csr_graph = CSRGraph(crs=meta["crs"], **arrays)
+    with open(os.path.join(cache_path, "kdtree.pickle"), 'rb') as treeFile:
+        csr_graph._tree = pickle.load(treeFile)
+    return csr_graph
+
+
+# Returns a hash of the graph's contents (nodes, edges, travel times and lengths), used to tell
+# whether results computed on a previous graph are still valid
+def graph_version(csr_graph):
+    version = hashlib.sha256()
+    for name in CACHE_ARRAYS:
+        version.update(np.ascontiguousarray(getattr(csr_graph, name)).tobytes())
+    return version.hexdigest()
@@ -0,0 +1,80 @@
+"""
+Hulls.py contains a built-in alpha shape (concave hull) implementation used to turn the
+nodes reached from a fire station into response time polygons.
+
+It follows the same algorithm as the alphashape package (Delaunay triangulation, keep
+the triangles whose circumradius is smaller than 1 / alpha, then polygonize their
+perimeter edges), but works directly on NumPy coordinate arrays. Since the response
+time bins are nested, the nodes of the largest bin are triangulated once and the
+smaller bins are derived by keeping only the triangles whose three vertices are
+reached within the bin's response time.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import numpy as np
+from scipy.spatial import Delaunay, QhullError
+from shapely.geometry import MultiPoint, MultiLineString
+from shapely.ops import polygonize, unary_union
+
+
+# Returns the circumradius of every triangle given the coordinates of its vertices
+# (arrays of shape (number of triangles, 3, 2)). Degenerate triangles get an infinite radius.
+def circumradii(triangles):
+    a = np.linalg.norm(triangles[:, 1] - triangles[:, 2], axis=1)
+    b = np.linalg.norm(triangles[:, 0] - triangles[:, 2], axis=1)
+    c = np.linalg.norm(triangles[:, 0] - triangles[:, 1], axis=1)
+    edges_1 = triangles[:, 1] - triangles[:, 0]
+    edges_2 = triangles[:, 2] - triangles[:, 0]
+    area = np.abs(edges_1[:, 0] * edges_2[:, 1] - edges_1[:, 1] * edges_2[:, 0]) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radii = a * b * c / (4 * area)
+    return np.where(area > 0, radii, np.inf)
+
+
+# Returns the polygon formed by a set of triangles (rows of vertex indices into coords)
+def triangles_to_polygon(coords, simplices):
+    # Perimeter edges are the edges that belong to exactly one triangle
+    edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [2, 0]]])
+    edges = np.sort(edges, axis=1)
+    edges, counts = np.unique(edges, axis=0, return_counts=True)
+    perimeter = edges[counts == 1]
+
+    lines = MultiLineString([coords[edge] for edge in perimeter])
+    return unary_union(list(polygonize(lines)))
+
+
+# Returns a list of alpha shapes, one per threshold, given the x/y coordinates of a set
+# of points and a value for each point (e.g. the arrival time at each node). The shape
+# for a threshold is built from the points whose value is lower or equal to it.
+def nested_alpha_shapes(x, y, values, thresholds, alpha):
+    values = np.asarray(values)
+    reached = values <= max(thresholds)
+    coords = np.column_stack((np.asarray(x)[reached], np.asarray(y)[reached]))
+    values = values[reached]
+
+    # Triangulate the largest point set once. Like the alphashape package, fall back
+    # to the convex hull when there are too few points (or they are all collinear).
+    try:
+        simplices = Delaunay(coords).simplices if len(coords) >= 4 else None
+    except QhullError:
+        simplices = None
+    if simplices is None:
+        return [MultiPoint(coords[values <= threshold]).convex_hull for threshold in thresholds]
+
+    # Keep the triangles that pass the alpha radius filter, and store the largest
+    # value of their vertices: a triangle belongs to every bin above that value
+    simplices = simplices[circumradii(coords[simplices]) < 1.0 / alpha]
+    triangle_values = values[simplices].max(axis=1)
+
+    # Bins with too few points, or whose triangles were all filtered out, also fall back
+    # to the convex hull of their points
+    polygons = []
+    for threshold in thresholds:
+        in_bin = values <= threshold
+        bin_simplices = simplices[triangle_values <= threshold]
+        if in_bin.sum() < 4 or len(bin_simplices) == 0:
+            polygons.append(MultiPoint(coords[in_bin]).convex_hull)
+        else:
+            polygons.append(triangles_to_polygon(coords, bin_simplices))
+    return polygons
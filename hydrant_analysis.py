@@ -1,5 +1,5 @@
 """
-Hydrant_analysis.py takes as input the hydrant_coords.geojson file,
+Hydrant_analysis.py takes as input the hydrant coordinate files of every hydrant type,
 sorts the hydrants based on flowrate (gallons per minute), 
 and outputs the following geojson files:
 - hydrant_unknown.geojson (hydrants with unknown flow rate)
@@ -10,116 +10,169 @@ and outputs the following geojson files:
 
 These files contain geometric circles drawn around every hydrant. The circle radius
 is 600 feet (183 meters), as this is the average maximum distance from which a fire engine 
-can source water from the fire hydrant.
+can source water from the fire hydrant. The circles are drawn in the hydrants' UTM zone
+so that their radius is true on the ground.
+
+When run with --dissolve, the overlapping circles are instead merged into a single
+(multi)polygon per hydrant type and flow class (Dry_Hydrant_coverage.geojson, ...),
+and the hydrant ids are written to a lightweight point layer (Dry_Hydrant_points.geojson, ...).
+These files are much smaller and faster to display than one circle per hydrant.
 
 Authors: Halcyon Brown & John Cambefort
 """
 
-import osmnx as ox
+import argparse
+import multiprocessing
+import numpy as np
 import geopandas as gpd
 import pandas as pd
-from tqdm import tqdm
-
-ox.config(log_console=False, use_cache=True)
-
-# Returns a circular buffer (in meters) around a hydrant given the hydrant coordinates 
-# and the radius of the buffer
-def make_buffer(hydrant, radius):
-    # Create the buffer
-    buffer = hydrant.buffer(radius)
-
-    # Convert from Polygon to GeoSeries and undo projection
-    buffer_series = gpd.GeoSeries(buffer, crs=3395)
-    buffer_series = buffer_series.to_crs("EPSG:4326")
-
-    # Convert from GeoSeries to GeoDataFrame
-    buffer_gdf = gpd.GeoDataFrame([buffer_series])
-    # Return the GeoDataFrame
-    return buffer_gdf
-
-########################################
-
-if __name__ == "__main__":
+from shapely.ops import unary_union
+from geojson_io import GeoJSONWriter
+from manifest import stage_is_current, record_stage
+from intermediates import intermediate_path, has_intermediate, read_intermediate
+from hydrants_coords_by_type import hydrant_type_list
+
+# Radius of the buffers in meters: 183 meters (600ft) - 305 meters = 1000ft
+BUFFER_RADIUS = 183
+
+# Size (in degrees) of the square tiles the buffers are partitioned into before being
+# dissolved (0.05 degrees is roughly 4 by 5.5 kilometers in Vermont)
+DISSOLVE_TILE_SIZE = 0.05
+
+# Number of worker processes used to dissolve the tiles
+WORKERS = 1
+
+# Number of decimals written for the coordinates of the hydrant point layers
+# (5 decimals of a degree is ~1 meter, plenty to click on a hydrant)
+POINT_PRECISION = 5
+
+# Returns the circular buffers (in meters) around every hydrant, as a GeoDataFrame in
+# lon/lat with the same columns as the hydrants. All the hydrants are buffered at once
+# in their local UTM zone, where distances are true on the ground (unlike in Mercator,
+# where 183 "meters" are only about 130 meters at Vermont's latitude), and the buffers
+# are projected back to lon/lat in a single call.
+def make_buffers(hydrants, radius):
+    projected = hydrants['geometry'].to_crs(hydrants.estimate_utm_crs())
+    buffers = projected.buffer(radius).to_crs("EPSG:4326")
+    return gpd.GeoDataFrame(hydrants.drop(columns='geometry'), geometry=buffers)
+
+
+# Returns the union of a list of geometries (called in the worker processes)
+def union_tile(geometries):
+    return unary_union(geometries)
+
+
+# Returns the buffers dissolved into a single (multi)polygon per hydrant type and flow
+# class, as a GeoDataFrame with "HYDRANTTYPE", "FLOWRATE", "count" and "geometry" columns.
+# The buffers are first partitioned into square tiles (by the center of their bounding box)
+# that are dissolved independently, in parallel if several workers are requested. Every
+# tile union only involves nearby circles, and the tiles of every class are then merged,
+# which only involves a few large polygons.
+def dissolve_buffers(buffers, tile_size=DISSOLVE_TILE_SIZE, workers=WORKERS):
+    bounds = buffers['geometry'].bounds
+    tiles = pd.DataFrame({
+        'HYDRANTTYPE': buffers['HYDRANTTYPE'].values,
+        'FLOWRATE': buffers['FLOWRATE'].values,
+        'tile_x': np.floor((bounds['minx'].values + bounds['maxx'].values) / 2 / tile_size),
+        'tile_y': np.floor((bounds['miny'].values + bounds['maxy'].values) / 2 / tile_size),
+        'geometry': buffers['geometry'].values,
+    })
+    grouped = tiles.groupby(['HYDRANTTYPE', 'FLOWRATE', 'tile_x', 'tile_y'], sort=False, dropna=False)
+    keys = list(grouped.groups.keys())
+    tile_geometries = [list(group['geometry']) for _, group in grouped]
+
+    # Dissolve every tile
+    if workers > 1:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            tile_unions = pool.map(union_tile, tile_geometries)
+    else:
+        tile_unions = list(map(union_tile, tile_geometries))
+
+    # Merge the tiles of every hydrant type and flow class
+    tiles = pd.DataFrame(keys, columns=['HYDRANTTYPE', 'FLOWRATE', 'tile_x', 'tile_y'])
+    tiles['count'] = [len(geometries) for geometries in tile_geometries]
+    tiles['geometry'] = tile_unions
+    rows = [(hydrant_type, flow_rate, group['count'].sum(), unary_union(list(group['geometry'])))
+        for (hydrant_type, flow_rate), group in tiles.groupby(['HYDRANTTYPE', 'FLOWRATE'], sort=False, dropna=False)]
+    dissolved = pd.DataFrame(rows, columns=['HYDRANTTYPE', 'FLOWRATE', 'count', 'geometry'])
+    return gpd.GeoDataFrame(dissolved, geometry='geometry', crs=buffers.crs)
+
+
+# Runs this stage given its command line arguments (read from sys.argv if None).
+# Also called in-process by pipeline.py.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the buffer polygons around every fire hydrant.")
+    parser.add_argument("--dissolve", action="store_true",
+        help="write one dissolved coverage polygon per hydrant type and flow class, and the "
+            "hydrant ids in a separate point layer, instead of one circle per hydrant")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+        help="number of worker processes used to dissolve the buffers")
+    args = parser.parse_args(argv)
 
     # Read in the five hydrant coordinate datasets outputted by hydrant_coords_by_type.py
-    file_paths = ["data/Dry_Hydrant_coords.geojson", "data/Drafting_Site_coords.geojson", 
-            "data/Municipal_Hydrant_coords.geojson", "data/Pressurized_Hydrant_coords.geojson", 
-            "data/Unknown_Type_coords.geojson"]
+    # (no file is written for the empty types)
+    file_names = [name for name in ["%s_coords" % hydrant_type.replace(" ", "_") for hydrant_type in hydrant_type_list]
+        if has_intermediate(name)]
+    file_paths = [intermediate_path(name) for name in file_names]
     # file_paths = ["Dry_Hydrant_coords.geojson", "Drafting_Site_coords.geojson", 
     #         "Municipal_Hydrant_coords.geojson", "Pressurized_Hydrant_coords.geojson", 
     #         "Unknown_Type_coords.geojson"]
+
+    # Skip this stage if the hydrants and options did not change since the last run
+    stage_inputs = file_paths + ["hydrant_analysis.py", "geojson_io.py", "intermediates.py"]
+    stage_params = {"dissolve": args.dissolve}
+    if stage_is_current("hydrant_analysis", stage_inputs, stage_params):
+        print("Hydrants are unchanged, skipping")
+        return
+
     dataframesList = []
-    for i in range(len(file_paths)):
-        hydrant_file = gpd.read_file(file_paths[i])
+    for i in range(len(file_names)):
+        hydrant_file = read_intermediate(file_names[i])
         dataframesList.append(hydrant_file)
     hydrants = gpd.GeoDataFrame(pd.concat(dataframesList, ignore_index=True), crs=dataframesList[0].crs)
 
     #hydrants = hydrants.head(50)
     # Read in hydrant coordinate data
     # hydrants = gpd.read_file("data/hydrant_coords.geojson")
-    
-    # Project the hydrant coordinates to Mercator
-    hydrants = hydrants.to_crs(epsg=3395)
-
-    # Initialize the dataframe that will hold all of the hydrant polygons
-    hydrant_polys_gdf = gpd.GeoDataFrame()
-
-    # Make a list containing the different hydrant colors based on flow rate (NFPA)
-    flow_rate_list = ['blue', 'green', 'orange', 'red', 'unknown']
-
-    # Make a list containing the different hydrant types 
-    hydrant_type_list = ['Dry Hydrant', 'Drafting Site', 'Municipal Hydrant', 'Pressurized Hydrant', 'Unknown Type']
-
-    # List of dataframes for each hydrant type
-    gdf_list = []
- 
-    # Initialize as many GeoDataFrames as there are hydrant type bins
-    # Store these new GeoDataFrames in the gdf_list array.
-    for i in range(len(hydrant_type_list)):
-        gdf_list.append(gpd.GeoDataFrame())
-
-    # Iterate through all of the hydants, creating the buffer polygons and add them to dataframe
-    for i in tqdm(range(len(hydrants))):
-        # Obtain the hydrant coordinates
-        hydrant_of_interest = hydrants['geometry'].loc[i]
-
-        # Obtain the flowrate
-        hydrant_color = hydrants['FLOWRATE'].loc[i]
-
-        # Obtain the hydrant type
-        hydrant_type = hydrants['HYDRANTTYPE'].loc[i]
-
-        # Obtain the hydrant id
-        hydrant_id = hydrants['HYDRANTID'].loc[i]
-
-        # The buffer is initialized as 183 meters (600ft) - 305 meters = 1000ft
-        buffer = make_buffer(hydrant_of_interest, 183)
-
-        # Rename the geometry column
-        buffer.columns = ['geometry']
-        # Add a flowrate column to buffer dataframe
-        buffer["FLOWRATE"] = hydrant_color
-        # Add a hydrant type column to the buffer dataframe 
-        buffer["HYDRANTTYPE"] = hydrant_type
-        #print(buffer["HYDRANTTYPE"])
-        #Add a hydrant id column to the buffer dataframe
-        buffer["HYDRANTID"] = hydrant_id
-        # Add the buffer to the dataframe for all hydrant buffers
-        hydrant_polys_gdf = hydrant_polys_gdf.append(buffer)
-
-    for j in range(len(hydrant_type_list)):
-        row = hydrant_polys_gdf.loc[
-            (hydrant_polys_gdf['HYDRANTTYPE'] == hydrant_type_list[j]), 
-            ['HYDRANTID', 'FLOWRATE', 'HYDRANTTYPE', 'geometry']
-        ]
-        gdf_list[j] = gdf_list[j].append(row)
-
-    # Convert each of the flow rate GeoDataFrames to geoJson files to be read by Leaflet
-    for i in range(len(gdf_list)):
-        hydrant_type = (hydrant_type_list[i]).replace(" ", "_")
-        # Check to see if any dataframes are empty and if so, do not export them to geojson
-        if (gdf_list[i]).empty:
-            continue
-        else:
-            gdf_list[i].to_file("data/%s.geojson" % (str(hydrant_type) + "_buffers"), driver="GeoJSON")
-            #gdf_list[i].to_file("%s.geojson" % (str(hydrant_type) + "_buffers"), driver="GeoJSON")
\ No newline at end of file
+
+    # Files that may be written (no file is written for empty types)
+    suffixes = ["_coverage", "_points"] if args.dissolve else ["_buffers"]
+    output_paths = ["data/%s%s.geojson" % (hydrant_type.replace(" ", "_"), suffix)
+        for hydrant_type in hydrant_type_list for suffix in suffixes]
+
+    # Skip hydrants whose type has no output file
+    hydrants = hydrants[hydrants['HYDRANTTYPE'].isin(hydrant_type_list)]
+
+    # Create the buffer polygons of all the hydrants at once
+    buffers = make_buffers(hydrants[['HYDRANTID', 'FLOWRATE', 'HYDRANTTYPE', 'geometry']], BUFFER_RADIUS)
+
+    # Dissolve the overlapping buffers, and keep the hydrant ids in a lightweight point
+    # layer per hydrant type (to be read by Leaflet). No file is written for empty types.
+    if args.dissolve:
+        coverage = dissolve_buffers(buffers, workers=args.workers)
+        for hydrant_type, type_coverage in coverage.groupby('HYDRANTTYPE', sort=False):
+            file_name = hydrant_type.replace(" ", "_")
+            print("Outputting %s_coverage.geojson and %s_points.geojson..." % (file_name, file_name))
+            with GeoJSONWriter("data/%s_coverage.geojson" % file_name) as writer:
+                writer.write_frame(type_coverage, ['HYDRANTTYPE', 'FLOWRATE', 'count'])
+            with GeoJSONWriter("data/%s_points.geojson" % file_name, POINT_PRECISION) as writer:
+                writer.write_frame(hydrants.loc[hydrants['HYDRANTTYPE'] == hydrant_type],
+                    ['HYDRANTID', 'FLOWRATE'])
+        record_stage("hydrant_analysis", stage_inputs, output_paths, stage_params)
+        return
+
+    # Write the buffers of every hydrant type, with their hydrant id, flowrate and
+    # hydrant type, to their own geoJson file (to be read by Leaflet).
+    # No file is written for empty types.
+    for hydrant_type, type_buffers in buffers.groupby('HYDRANTTYPE', sort=False):
+        file_name = hydrant_type.replace(" ", "_") + "_buffers"
+        print("Outputting %s.geojson..." % file_name)
+        with GeoJSONWriter("data/%s.geojson" % file_name) as writer:
+            writer.write_frame(type_buffers, ['HYDRANTID', 'FLOWRATE', 'HYDRANTTYPE'])
+
+    record_stage("hydrant_analysis", stage_inputs, output_paths, stage_params)
+
+########################################
+
+if __name__ == "__main__":
+    main()
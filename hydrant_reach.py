@@ -0,0 +1,131 @@
+"""
+Hydrant_reach.py is similar to hydrant_analysis.py. However, instead of straight-line
+circles around every hydrant, it outputs the areas a fire engine can reach by laying hose
+along the roads (and driveways) from a hydrant, for a few hose lengths.
+
+All the hydrants are snapped to the road network graph built by network_analysis.py
+(read from its cache) in a single query. Then, for every hydrant type and flow class,
+a single multi-source search measured in meters is run from all of its hydrants at once
+(see routing.CSRGraph.source_distances), instead of one search per hydrant. The distance
+between a hydrant and its nearest road node counts towards the hose length.
+
+The reach polygons are made of the road sections within the hose length of a hydrant
+(including partially covered roads), widened by ROAD_BUFFER meters on both sides.
+
+This module outputs the following files:
+- Dry_Hydrant_reach.geojson (one polygon per flow class and hose length)
+- Drafting_Site_reach.geojson
+- Municipal_Hydrant_reach.geojson
+- Pressurized_Hydrant_reach.geojson
+- Unknown_Type_reach.geojson
+
+It takes as input the hydrant coordinate datasets outputted by hydrants_coords_by_type.py.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.ops import unary_union
+from geojson_io import GeoJSONWriter
+from network_analysis import load_graph
+from intermediates import has_intermediate, read_intermediate
+
+# Hose lengths (in meters) for which a reach polygon is computed: 600ft and 1000ft
+HOSE_LENGTHS = [183, 305]
+
+# Distance (in meters) on both sides of the road covered by the reach polygons
+ROAD_BUFFER = 30
+
+
+# Returns a list of polygons (in the graph's projected CRS), one per hose length, covering
+# the road sections within the hose length, given the distance (in meters) from the closest
+# hydrant to every node of the CSRGraph (infinity for nodes that were not reached)
+def reach_polygons(csr_graph, distances, hose_lengths, road_buffer=ROAD_BUFFER):
+    # Every road is stored once in each direction, keep a single copy of it
+    u = np.repeat(np.arange(csr_graph.n_nodes, dtype=np.int64), np.diff(csr_graph.indptr))
+    v = csr_graph.indices.astype(np.int64)
+    _, first = np.unique(np.minimum(u, v) * csr_graph.n_nodes + np.maximum(u, v), return_index=True)
+    u, v, lengths = u[first], v[first], csr_graph.length[first]
+    start = np.column_stack((csr_graph.x[u], csr_graph.y[u]))
+    end = np.column_stack((csr_graph.x[v], csr_graph.y[v]))
+
+    polygons = []
+    for hose_length in hose_lengths:
+        # Length of every edge covered from each of its two ends
+        from_u = np.clip(hose_length - distances[u], 0, lengths)
+        from_v = np.clip(hose_length - distances[v], 0, lengths)
+        whole = from_u + from_v >= lengths
+        from_u = np.where(whole, lengths, from_u) / lengths
+        from_v = np.where(whole, 0, from_v) / lengths
+
+        # Section covered from the first end, and from the second end (unless the
+        # first section already covers the whole edge)
+        ends = [(start, start + from_u[:, None] * (end - start), from_u > 0),
+            (end, end + from_v[:, None] * (start - end), from_v > 0)]
+        lines = [shapely.linestrings(np.stack((line_start[covered], line_end[covered]), axis=1))
+            for line_start, line_end, covered in ends]
+        polygons.append(unary_union(shapely.buffer(np.concatenate(lines), road_buffer)))
+    return polygons
+
+
+# Returns the hydrants read from the intermediate files of every hydrant type
+# (see hydrants_coords_by_type.py), skipping the types without a file
+def read_hydrants(file_names):
+    dataframesList = [read_intermediate(name) for name in file_names if has_intermediate(name)]
+    hydrants = gpd.GeoDataFrame(pd.concat(dataframesList, ignore_index=True), crs=dataframesList[0].crs)
+    return hydrants[~(hydrants['geometry'].isna() | hydrants['geometry'].is_empty)].reset_index(drop=True)
+
+
+# Runs this stage given its command line arguments (read from sys.argv if None).
+# Also called in-process by pipeline.py.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the hose reach polygons along the roads around every fire hydrant.")
+    parser.add_argument("--hose-lengths", type=float, nargs="+", default=HOSE_LENGTHS,
+        help="hose lengths (in meters) for which a reach polygon is computed")
+    parser.add_argument("--road-buffer", type=float, default=ROAD_BUFFER,
+        help="distance (in meters) on both sides of the road covered by the reach polygons")
+    parser.add_argument("--osm-file",
+        help="local OpenStreetMap extract (.osm or .osm.pbf) the graph is built from (see osm_extract.py), "
+            "must match the one given to network_analysis.py")
+    args = parser.parse_args(argv)
+    hose_lengths = sorted(args.hose_lengths)
+
+    # Read in the five hydrant coordinate datasets outputted by hydrant_coords_by_type.py
+    file_names = ["Dry_Hydrant_coords", "Drafting_Site_coords", "Municipal_Hydrant_coords",
+            "Pressurized_Hydrant_coords", "Unknown_Type_coords"]
+    hydrants = read_hydrants(file_names)
+
+    # Reuse the graph built (and cached) by network_analysis.py
+    bounding_zone = read_intermediate("vermont_state_polygon")["geometry"].loc[0]
+    print("Making graph...")
+    csr_graph, _ = load_graph(bounding_zone, args.osm_file)
+    print("Vermont graph made!")
+
+    # Snap every hydrant to its nearest graph node in a single spatial index query
+    projected = hydrants['geometry'].to_crs(csr_graph.crs)
+    hydrant_indices, snap_distances = csr_graph.snap(projected.x, projected.y)
+
+    # One geoJson file per hydrant type, holding a polygon per flow class and hose length
+    for hydrant_type, type_group in hydrants.groupby('HYDRANTTYPE', sort=False):
+        file_name = hydrant_type.replace(" ", "_") + "_reach"
+        with GeoJSONWriter("data/%s.geojson" % file_name) as writer:
+            for flow_rate, group in type_group.groupby('FLOWRATE', sort=False):
+                print("Computing the reach of %d %s hydrants (%s)..." % (len(group), hydrant_type, flow_rate))
+                positions = group.index.values
+                distances = csr_graph.source_distances(hydrant_indices[positions], snap_distances[positions],
+                    limit=max(hose_lengths))
+                polygons = gpd.GeoSeries(reach_polygons(csr_graph, distances, hose_lengths, args.road_buffer),
+                    crs=csr_graph.crs).to_crs("EPSG:4326")
+
+                for hose_length, polygon in zip(hose_lengths, polygons):
+                    writer.write(polygon, {"FLOWRATE": flow_rate,
+                        "HYDRANTTYPE": hydrant_type, "hose_length": hose_length})
+
+########################################
+
+if __name__ == "__main__":
+    main()
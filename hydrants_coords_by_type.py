@@ -8,115 +8,98 @@ This module currently outputs the following files:
 - Pressurized_Hydrant_coords.geojson (contains the pressurized hydrants)
 - Unknown_Type_coords.geojson (contains the hydrants with unknown types)
 
-It takes as input the hydrant_coords.geojson file that is created by produce_geojson.
+It takes as input the hydrant_coords intermediate file that is created by produce_geojson.
+Every file is also written as an intermediate file (see intermediates.py), which is
+read by hydrant_analysis.py.
+
+Every hydrant is given a flow rate class (color) and a hydrant type, both looked up in the
+tables below for all the hydrants at once.
 
 These files are then used on the front end.
 
 Authors: Halcyon Brown & John Cambefort
 """
 
-import geopandas as gpd
-from tqdm import tqdm
+import numpy as np
+import pandas as pd
+from intermediates import read_intermediate, write_intermediate
+
+# NFPA flow rate classes, as (minimum flow rate in gallons per minute, color) in increasing order:
+# red (less than 500 gpm), orange (500 to 1000), green (1000 to 1500) and blue (1500 or more)
+FLOW_RATE_CLASSES = [(0, 'red'), (500, 'orange'), (1000, 'green'), (1500, 'blue')]
+
+# Class of the hydrants whose flow rate is missing or cannot be read
+UNKNOWN_FLOW_RATE = 'unknown'
 
-# Read in hydrant coordinate data
-hydrants = gpd.read_file("data/hydrant_coords.geojson")
-#hydrants = gpd.read_file("hydrant_coords_test.geojson")
-#hydrants = hydrants.head(100)
+# Hydrant types corresponding to the HYDRANTTYPE codes
+HYDRANT_TYPES = {"H1": "Municipal Hydrant", "H2": "Dry Hydrant", "H3": "Pressurized Hydrant", "H4": "Drafting Site"}
 
-# Figure out the different hydrant flow rate categories
-for i in range(len(hydrants)):
-    flow_rate = hydrants['FLOWRATE'].loc[i]
-    if flow_rate is not None:
-        edited_rate = flow_rate.split("g")[0]
-        hydrants['FLOWRATE'].loc[i] = int(edited_rate)
-    flow = hydrants['FLOWRATE'].loc[i]
+# Type of the hydrants whose code is missing or not in the table above
+UNKNOWN_TYPE = "Unknown Type"
 
-# Make a list containing the different hydrant colors based on hydrant type
+# Make a list containing the different hydrant types (one output file each)
 hydrant_type_list = ['Dry Hydrant', 'Drafting Site', 'Municipal Hydrant', 'Pressurized Hydrant', 'Unknown Type']
 
-# List of dataframes for each hydrant_type
-gdf_list = []
-
-# Initialize dataframe to hold new hydrant entries
-new_hydrant_gdf = gpd.GeoDataFrame()
-
-# Initialize as many GeoDataFrames as there are hydrant_type bins
-# Store these new GeoDataFrames in the gdf_list array.
-for i in range(len(hydrant_type_list)):
-    gdf_list.append(gpd.GeoDataFrame())
-
-# Iterate through all of the hydants, determining hydrant color and type and add them to dataframe
-for i in tqdm(range(len(hydrants))):
-    # Obtain the hydrant coordinates
-    hydrant_of_interest = hydrants['geometry'].loc[i]
-
-    # Obtain the flowrate
-    flow_rate = hydrants['FLOWRATE'].loc[i]
-
-    # Obtain the hydrant type (coded as H1, H2, H3, H4)
-    coded_type = hydrants['HYDRANTTYPE'].loc[i]
-    #print(coded_type)
-
-    # Figure out what hydrant color the flow_rate corresponds to
-    hydrant_color = ""
-    if (flow_rate == None):
-        hydrant_color = 'unknown' 
-    elif (int(flow_rate) >= 1500):
-        hyrant_color = 'blue'
-    elif (int(flow_rate) >= 1000 and int(flow_rate) < 1500):
-        hydrant_color = 'green'
-    elif (int(flow_rate) >= 500 and int(flow_rate) < 1000):
-        hydrant_color = 'orange'
-    elif (int(flow_rate) < 500):
-        hydrant_color = 'red'
-    else:
-        hydrant_color = 'unknown'
-
-
-    # Figure out what hydrant type the hydrant corresponds to based on HYDRANTTYPE
-    hydrant_type = ""
-    if (coded_type == "H1"):
-        hydrant_type = "Municipal Hydrant"
-    elif (coded_type == "H2"):
-        hydrant_type = "Dry Hydrant"
-    elif (coded_type == "H3"):
-        hydrant_type = "Pressurized Hydrant"
-    elif (coded_type == "H4"):
-        hydrant_type = "Drafting Site"
-    else:
-        hydrant_type = "Unknown Type"
-
-    # Add a flowrate column to hydrant dataframe
-    #hydrant_of_interest["FLOWRATE"] = hydrant_color
-    hydrants["FLOWRATE"].loc[i] = hydrant_color
-    #print(hydrant_color)
-    #print(hydrants["FLOWRATE"].loc[i])
-
-    # Add a hydrant type column to the buffer dataframe 
-    #hydrant_of_interest["HYDRANTTYPE"] = hydrant_type
-    hydrants["HYDRANTTYPE"].loc[i] = hydrant_type
-    #print(hydrants["HYDRANTTYPE"].loc[i])
-    #print(hydrant_type)
-    # Add the buffer to the dataframe for all hydrant buffers
-    #new_hydrant_gdf = new_hydrant_gdf.append(hydrant_of_interest)
-
-for j in range(len(hydrant_type_list)):
-    row = hydrants.loc[
-        (hydrants['HYDRANTTYPE'] == hydrant_type_list[j]), 
-        ['HYDRANTID','FLOWRATE', 'HYDRANTTYPE', 'geometry']
-    ]
-    gdf_list[j] = gdf_list[j].append(row)
-
-# Convert each of the hydrant type GeoDataFrames to geoJson files to be read by Leaflet
-for i in range(len(gdf_list)):
-    hyd_type = (hydrant_type_list[i]).replace(" ", "_")
-    # Check to see if any dataframes are empty and if so, do not export them to geojson
-    if (gdf_list[i]).empty:
-        print("empty")
-        print(hyd_type)
-        continue
-    else:
+
+# Returns the flow rates (in gallons per minute) read from the FLOWRATE strings
+# (e.g. "1000gpm"), with NaN for the missing or unreadable ones
+def parse_flow_rates(flow_rates):
+    numbers = flow_rates.astype("string").str.extract(r"^\s*(\d+(?:\.\d+)?)", expand=False)
+    return pd.to_numeric(numbers, errors='coerce').astype(float)
+
+
+# Returns the flow rate class (color) of every flow rate, following FLOW_RATE_CLASSES
+def flow_rate_classes(flow_rates):
+    minimums = np.array([minimum for minimum, _ in FLOW_RATE_CLASSES])
+    colors = np.array([color for _, color in FLOW_RATE_CLASSES] + [UNKNOWN_FLOW_RATE], dtype=object)
+    rates = np.asarray(flow_rates, dtype=float)
+
+    # Index of the highest class whose minimum the flow rate reaches
+    # (the last index, i.e. unknown, for missing flow rates and rates below every class)
+    classes = np.searchsorted(minimums, rates, side='right') - 1
+    classes[np.isnan(rates) | (classes < 0)] = len(FLOW_RATE_CLASSES)
+    return colors[classes]
+
+
+# Returns the hydrants with their FLOWRATE replaced by the flow rate class (color) and
+# their HYDRANTTYPE code replaced by the hydrant type name
+def classify_hydrants(hydrants):
+    hydrants = hydrants.copy()
+    hydrants['FLOWRATE'] = flow_rate_classes(parse_flow_rates(hydrants['FLOWRATE']))
+    hydrants['HYDRANTTYPE'] = hydrants['HYDRANTTYPE'].map(HYDRANT_TYPES).fillna(UNKNOWN_TYPE)
+    return hydrants
+
+
+# Writes the hydrants of every type to their own geoJson file (to be read by Leaflet)
+# and intermediate file
+def write_hydrants_by_type(hydrants, path_format="data/%s_coords.geojson"):
+    columns = ['HYDRANTID', 'FLOWRATE', 'HYDRANTTYPE', 'geometry']
+    groups = dict(list(hydrants[columns].groupby('HYDRANTTYPE', sort=False)))
+    for hydrant_type in hydrant_type_list:
+        hyd_type = hydrant_type.replace(" ", "_")
+        # Check to see if any dataframes are empty and if so, do not export them to geojson
+        if hydrant_type not in groups:
+            print("empty")
+            print(hyd_type)
+            continue
         print("outputting %s geojson file" % (hyd_type))
-        #print(gdf_list[i])
-        gdf_list[i].to_file("data/%s_coords.geojson" % (str(hyd_type)), driver="GeoJSON")
-        #gdf_list[i].to_file("%s_coords.geojson" % (str(hyd_type)), driver="GeoJSON")
\ No newline at end of file
+        groups[hydrant_type].to_file(path_format % hyd_type, driver="GeoJSON")
+        write_intermediate(groups[hydrant_type], "%s_coords" % hyd_type)
+
+
+# Runs this stage (also called in-process by pipeline.py)
+def main():
+    # Read in hydrant coordinate data
+    hydrants = read_intermediate("hydrant_coords")
+    #hydrants = gpd.read_file("hydrant_coords_test.geojson")
+    #hydrants = hydrants.head(100)
+
+    # Figure out the hydrant colors (flow rate) and types of all the hydrants
+    hydrants = classify_hydrants(hydrants)
+
+    write_hydrants_by_type(hydrants)
+
+########################################
+
+if __name__ == "__main__":
+    main()
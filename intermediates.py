@@ -0,0 +1,70 @@
+"""
+Intermediates.py reads and writes the files passed between the stages of the pipeline.
+
+These files are written as GeoParquet (a columnar binary format) in the intermediate
+folder rather than as GeoJSON text in the data folder: they are much faster to read,
+a stage can read only the columns it needs, and the column types (e.g. the integer ESN
+numbers) are kept exactly as they were written. GeoJSON is only written for the layers
+displayed on the website (see geojson_io.py).
+
+The following intermediate files are produced:
+- fire_station_coords, hydrant_coords, zone_polygons, vermont_state_polygon (produce_geojson.py)
+- updated_stations_coords (match_departments.py)
+- Dry_Hydrant_coords, Drafting_Site_coords, ... (hydrants_coords_by_type.py)
+
+When the stages run in a single process (see pipeline.py), the intermediate files are
+also kept in memory, so a stage does not need to read back what another stage just wrote.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import os
+import geopandas as gpd
+
+# Folder holding the intermediate files
+INTERMEDIATE_PATH = "intermediate"
+
+# Intermediate files kept in memory (name -> GeoDataFrame), None unless keep_in_memory() was called
+_memory = None
+
+
+# Keeps the intermediate files written from now on in memory, in addition to writing them to disk
+def keep_in_memory():
+    global _memory
+    if _memory is None:
+        _memory = {}
+
+
+# Returns the path of an intermediate file given its name (e.g. "zone_polygons")
+def intermediate_path(name):
+    return os.path.join(INTERMEDIATE_PATH, "%s.parquet" % name)
+
+
+# Writes a GeoDataFrame to an intermediate file
+def write_intermediate(gdf, name):
+    if not os.path.exists(INTERMEDIATE_PATH):
+        os.makedirs(INTERMEDIATE_PATH, exist_ok=True)
+
+    # Write to a temporary file first so that a crash never leaves a partial file behind
+    path = intermediate_path(name)
+    tmp_path = path + ".tmp"
+    gdf.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+    # The index is not written to the file, drop it from the in-memory copy as well
+    if _memory is not None:
+        _memory[name] = gdf.reset_index(drop=True)
+
+
+# Returns whether an intermediate file was written
+def has_intermediate(name):
+    return (_memory is not None and name in _memory) or os.path.exists(intermediate_path(name))
+
+
+# Returns the GeoDataFrame stored in an intermediate file (with only the given columns,
+# all of them if None). Stages may modify it, so the in-memory copies are never returned directly.
+def read_intermediate(name, columns=None):
+    if _memory is not None and name in _memory:
+        gdf = _memory[name]
+        return (gdf if columns is None else gdf[columns]).copy()
+    return gpd.read_parquet(intermediate_path(name), columns=columns)
@@ -0,0 +1,84 @@
+"""
+Isochrone_cache.py stores the response time polygons of every fire station on disk,
+so that network_analysis.py only recomputes the stations whose inputs changed.
+
+Each station's polygons are stored in their own file, named after a hash of everything
+that determines them: the graph node the station is snapped to, the response time
+bins, the polygon (hull) parameters and the version of the graph. A station whose key
+is unchanged is simply read back from its file. Since every file is written as soon
+as its station is finished, an interrupted run resumes from where it stopped.
+
+The files are stored in one directory per graph version. A new graph (e.g. built from
+a newer OpenStreetMap extract) invalidates every station, so the directories of the
+other versions are deleted when the cache is opened and the cache does not keep growing.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import os
+import json
+import shutil
+import hashlib
+from shapely import wkb
+
+# Directory holding the per-station polygon files
+ISOCHRONE_CACHE_PATH = "isochrone_cache"
+
+
+# Returns the directory holding the polygons computed on the graph with the given version
+# (see graph_cache.graph_version), after deleting the polygons of every other version
+def open_station_cache(cache_path, graph_version):
+    if os.path.exists(cache_path):
+        stale = [entry for entry in os.listdir(cache_path) if entry != graph_version]
+        if stale:
+            print("Removing %d outdated entries from %s" % (len(stale), cache_path))
+        for entry in stale:
+            path = os.path.join(cache_path, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    return os.path.join(cache_path, graph_version)
+
+
+# Returns the cache key of a station's polygons
+def station_key(station_node, response_times, hull_params, graph_version):
+    key = {
+        "station_node": int(station_node),
+        "response_times": list(response_times),
+        "hull_params": hull_params,
+        "graph_version": graph_version,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+# Returns the path of the file holding the polygons stored under a key
+def station_path(cache_path, key):
+    return os.path.join(cache_path, key + ".json")
+
+
+# Returns whether polygons are stored under a key
+def has_station_polygons(cache_path, key):
+    return os.path.exists(station_path(cache_path, key))
+
+
+# Returns the list of polygons (one per response time bin) stored under a key,
+# or None if the station has not been computed yet
+def load_station_polygons(cache_path, key):
+    if not has_station_polygons(cache_path, key):
+        return None
+    with open(station_path(cache_path, key)) as jsonFile:
+        return [wkb.loads(geometry, hex=True) for geometry in json.load(jsonFile)["geometries"]]
+
+
+# Stores the list of polygons (one per response time bin) of a station under a key
+def save_station_polygons(cache_path, key, polygons):
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path, exist_ok=True)
+
+    # Write to a temporary file first so that a crash never leaves a partial file behind
+    path = station_path(cache_path, key)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w') as jsonFile:
+        json.dump({"geometries": [polygon.wkb_hex for polygon in polygons]}, jsonFile)
+    os.replace(tmp_path, path)
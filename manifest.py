@@ -0,0 +1,120 @@
+"""
+Manifest.py keeps track of the files produced by the pipeline, so that stages whose
+inputs did not change since their last run can be skipped.
+
+The manifest (pipeline_manifest.json) records:
+- "files": the sha256 content hash of every raw and intermediate file, along with its
+  size and modification time (a file whose size and modification time are unchanged
+  is not hashed again)
+- "downloads": the ETag / Last-Modified validators sent by the server for every
+  downloaded dataset (see datasets.py), used to make conditional requests
+- "stages": for every stage, the hashes of the inputs it was last run on, its parameters
+  and the hashes of the outputs it produced
+
+A stage is up to date when its inputs (data files and source code) and parameters are the
+same as on its last run, and its outputs still exist unchanged.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+# Path of the manifest file
+MANIFEST_PATH = "pipeline_manifest.json"
+
+# Size (in bytes) of the blocks read to hash a file
+HASH_BLOCK_SIZE = 1 << 20
+
+# Stages may run in several threads, the manifest is read and written under this lock
+_lock = threading.Lock()
+
+
+# Returns the manifest stored at path (an empty manifest if there is none yet)
+def load_manifest(path=MANIFEST_PATH):
+    manifest = {"files": {}, "downloads": {}, "stages": {}}
+    if os.path.exists(path):
+        with open(path) as manifestFile:
+            manifest.update(json.load(manifestFile))
+    return manifest
+
+
+# Writes the manifest to path (through a temporary file, so it is never left half written)
+def save_manifest(manifest, path=MANIFEST_PATH):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as manifestFile:
+        json.dump(manifest, manifestFile, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+# Returns the sha256 hash of a file's contents (None if it does not exist), reusing the
+# hash stored in the manifest if the file's size and modification time are unchanged
+def file_hash(manifest, file_path):
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    entry = manifest["files"].get(file_path)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as inputFile:
+        for block in iter(lambda: inputFile.read(HASH_BLOCK_SIZE), b""):
+            content_hash.update(block)
+    manifest["files"][file_path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+        "sha256": content_hash.hexdigest()}
+    return content_hash.hexdigest()
+
+
+# Returns the parameters as they are stored in the manifest (e.g. tuples become lists)
+def normalize_params(params):
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+# Returns whether a stage was already run on the same inputs (list of file paths) and
+# parameters (JSON-serializable), and its outputs are still there unchanged
+def stage_is_current(stage, inputs, params=None, path=MANIFEST_PATH):
+    params = normalize_params(params)
+    with _lock:
+        manifest = load_manifest(path)
+        record = manifest["stages"].get(stage)
+        if record is None:
+            return False
+        input_hashes = {file_path: file_hash(manifest, file_path) for file_path in inputs}
+        current = (record["inputs"] == input_hashes and record["params"] == params
+            and all(file_hash(manifest, file_path) == output_hash
+                for file_path, output_hash in record["outputs"].items()))
+        save_manifest(manifest, path)
+    return current
+
+
+# Records that a stage was run on the given inputs and parameters, and produced the given
+# outputs (list of file paths, the ones that do not exist are ignored)
+def record_stage(stage, inputs, outputs, params=None, path=MANIFEST_PATH):
+    params = normalize_params(params)
+    with _lock:
+        manifest = load_manifest(path)
+        manifest["stages"][stage] = {
+            "inputs": {file_path: file_hash(manifest, file_path) for file_path in inputs},
+            "params": params,
+            "outputs": {file_path: file_hash(manifest, file_path) for file_path in outputs
+                if os.path.exists(file_path)},
+        }
+        save_manifest(manifest, path)
+
+
+# Returns the ETag / Last-Modified validators recorded for a downloaded file
+def download_validators(file_path, path=MANIFEST_PATH):
+    with _lock:
+        return load_manifest(path)["downloads"].get(file_path, {})
+
+
+# Records the ETag / Last-Modified validators sent by the server for a downloaded file
+def record_download(file_path, validators, path=MANIFEST_PATH):
+    with _lock:
+        manifest = load_manifest(path)
+        manifest["downloads"][file_path] = validators
+        file_hash(manifest, file_path)
+        save_manifest(manifest, path)
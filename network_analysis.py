@@ -11,6 +11,25 @@ This module currently outputs the following files:
 - 10.geojson
 - 20.geojson
 
+When run with --mode first-due, it instead outputs non-overlapping first-due polygons
+(2_first_due.geojson, 5_first_due.geojson, ...) in which every area is assigned to
+the FIRE_AgencyId of the closest station only.
+
+When run with --esn, it also outputs the polygons bounded by the Emergency Service Zones
+(2_esn.geojson, ..., and esn_zones.geojson) in the same pass, without analysis_by_esn.py
+having to read the files above back.
+
+When run with --mode esn, every station's search is restricted to its own Emergency Service
+Zone plus a margin, and only the ESN-bounded files are output. This is much cheaper than
+computing the statewide polygons and clipping them afterwards.
+
+The polygons of every station are also stored in isochrone_cache/ (see isochrone_cache.py),
+so that later runs only recompute the stations whose inputs changed. The whole stage is
+skipped when its input files, source code and options are unchanged (see manifest.py).
+
+The road network graph is downloaded from the Overpass API, or read from a local
+OpenStreetMap extract when run with --osm-file (see osm_extract.py).
+
 It takes as input the data files fetched by datasets.py.
 
 Based on code from https://towardsdatascience.com/how-to-calculate-travel-time-for-any-location-in-the-world-56ce639511f
@@ -19,127 +38,424 @@ and https://github.com/gboeing/osmnx-examples/blob/7cb65dbd64b5923a6013a94b72585
 Authors: Halcyon Brown & John Cambefort
 """
 
-import os
+import heapq
+import hashlib
+import argparse
+import multiprocessing
+from contextlib import ExitStack
+import numpy as np
 import osmnx as ox
 import networkx as nx
+import pandas as pd
 import geopandas as gpd
 from shapely.geometry import Point
 import alphashape
 from tqdm import tqdm
+from config import RESPONSE_TIMES
+from routing import CSRGraph
+from hulls import nested_alpha_shapes
+from geojson_io import GeoJSONWriter
+from analysis_by_esn import prepare_zones, clip_to_zones
+from raster import raster_isochrones, RASTER_CELL_SIZE
+from osm_extract import graph_from_osm_file
+from graph_cache import cache_key, graph_version, load_graph_cache, save_graph_cache
+from isochrone_cache import (ISOCHRONE_CACHE_PATH, open_station_cache, station_key, has_station_polygons,
+    load_station_polygons, save_station_polygons)
+from manifest import stage_is_current, record_stage, load_manifest, file_hash
+from intermediates import intermediate_path, read_intermediate
 
 ox.config(log_console=False,
             use_cache=True,
             bidirectional_network_types=['drive_service'])
 
-# Response time bins to used for the network analysis (values in seconds)
-RESPONSE_TIMES = [120, 300, 600, 1200]
-
-# Returns a Graph of edges & nodes within the bounding_zone polygon geometry
-def make_graph(bounding_zone):
+# Road network type used to build the graph (all roads including service roads)
+NETWORK_TYPE = 'drive_service'
+
+# Default speed values (km/hour) to fill in edges from Open Street Maps
+# with missing `maxspeed` values
+HWY_SPEEDS = {"residential": 40, 
+            "unclassified": 40,
+            "tertiary": 56, 
+            "secondary": 56, 
+            "primary": 80, 
+            "trunk": 56
+            }
+# # 25 mph, 35 mph, 50 mph
+
+# Directory holding the binary cache of the Vermont graph (see graph_cache.py)
+GRAPH_CACHE_PATH = "vermont_graph_cache"
+
+# Stations further than this distance (in meters) from their nearest graph node are reported
+SNAP_WARNING_DISTANCE = 200
+
+# Routing engine used to compute the station arrival times:
+# - "networkx" runs one NetworkX Dijkstra search per station
+# - "csr" converts the graph to arrays (see routing.py) and routes all stations in one batch
+ROUTING_ENGINES = ["networkx", "csr"]
+ROUTING_ENGINE = "networkx"
+
+# Analysis mode:
+# - "station" builds the full (overlapping) response polygons of every station
+# - "first-due" labels every road node with its closest station in one multi-source
+#   search and builds non-overlapping polygons per FIRE_AgencyId (<bin>_first_due.geojson)
+# - "esn" only searches the road network within each station's Emergency Service Zone
+#   (plus ESN_MARGIN meters) and outputs the ESN-bounded polygons (<bin>_esn.geojson)
+ANALYSIS_MODES = ["station", "first-due", "esn"]
+ANALYSIS_MODE = "station"
+
+# Distance (in meters) around a station's zone that its search may still go through
+# in the "esn" mode, so roads leaving and re-entering the zone are still used
+ESN_MARGIN = 2000
+
+# Backend used to build the polygon of the nodes reached in each bin:
+# - "alphashape" calls the alphashape package once per bin
+# - "triangulation" uses hulls.py, which triangulates a station's nodes once for all bins
+# - "raster" uses raster.py, which traces all bins from a grid of arrival times
+#   (requires the csr engine)
+HULL_BACKENDS = ["alphashape", "triangulation", "raster"]
+HULL_BACKEND = "alphashape"
+
+# Alpha parameter of the concave hulls (computed on lon/lat coordinates)
+ALPHA = 50
+
+# Number of worker processes used to compute the station polygons (1 = serial)
+WORKERS = 1
+
+# Data files and source files the polygons depend on
+INPUT_FILES = [intermediate_path("updated_stations_coords"), intermediate_path("vermont_state_polygon"),
+    intermediate_path("zone_polygons")]
+SOURCE_FILES = ["network_analysis.py", "routing.py", "hulls.py", "raster.py", "graph_cache.py",
+    "isochrone_cache.py", "analysis_by_esn.py", "geojson_io.py", "intermediates.py", "config.py",
+    "osm_extract.py"]
+
+# Returns a Graph of edges & nodes within the bounding_zone polygon geometry, read from
+# a local OpenStreetMap extract (.osm or .osm.pbf) if one is given, downloaded otherwise
+def make_graph(bounding_zone, osm_file=None):
 
     # Create a graph based on a drive_service (all roads including service roads) road network
-    G = ox.graph_from_polygon(bounding_zone, network_type='drive_service')
+    if osm_file is None:
+        G = ox.graph_from_polygon(bounding_zone, network_type=NETWORK_TYPE)
+    else:
+        G = graph_from_osm_file(osm_file, bounding_zone, NETWORK_TYPE)
 
     # Project the graph from lat-long to the UTM zone appropriate for its geographic location.
     G = ox.project_graph(G)
 
-    # Pass in default speed values (km/hour) to fill in edges from Open Street Maps
-    # with missing `maxspeed` values
-    hwy_speeds = {"residential": 40, 
-                "unclassified": 40,
-                "tertiary": 56, 
-                "secondary": 56, 
-                "primary": 80, 
-                "trunk": 56
-                }
-    # # 25 mph, 35 mph, 50 mph
-
-    G = ox.add_edge_speeds(G, hwy_speeds)
+    # Pass in default speed values to fill in edges with missing `maxspeed` values
+    G = ox.add_edge_speeds(G, HWY_SPEEDS)
     G = ox.add_edge_travel_times(G)
 
     return G
 
 
+# CSRGraphs loaded by load_graph(), keyed by their cache key
+_loaded_graphs = {}
+
+
+# Returns the CSRGraph of the road network within the bounding_zone polygon, read from
+# the binary cache at GRAPH_CACHE_PATH, along with the NetworkX graph if it was built.
+# The cache is rebuilt (with make_graph()) whenever the bounding zone, the default speeds,
+# the network type or the content of the osm_file change, in which case the NetworkX graph
+# is returned instead of None.
+# The CSRGraph is also kept in memory, so that the stages run by pipeline.py in the same
+# process (e.g. hydrant_reach.py) do not read the cache again.
+def load_graph(bounding_zone, osm_file=None):
+    G = None
+    source = file_hash(load_manifest(), osm_file) if osm_file is not None else None
+    key = cache_key(bounding_zone, HWY_SPEEDS, NETWORK_TYPE, source)
+    if key in _loaded_graphs:
+        return _loaded_graphs[key], G
+    csr_graph = load_graph_cache(GRAPH_CACHE_PATH, key)
+    if csr_graph is None:
+        G = make_graph(bounding_zone, osm_file)
+        csr_graph = CSRGraph.from_networkx(G)
+        save_graph_cache(csr_graph, GRAPH_CACHE_PATH, key)
+    _loaded_graphs[key] = csr_graph
+    return csr_graph, G
+
+
+# Returns the graph the CSR engine routes the stations on: the CSRGraph without its dead ends
+# and road chains (see routing.ContractedGraph), which still returns the arrival times of
+# every node. The station nodes are never removed.
+def contract_graph(csr_graph, station_indices):
+    print("Contracting graph...")
+    routing_graph = csr_graph.contract(station_indices)
+    print("Routing on %d of %d nodes" % (routing_graph.core.n_nodes, csr_graph.n_nodes))
+    return routing_graph
+
+
 # Returns a GeoDataFrame containing polygon geometries and a response time column
-def compute_subgraphs(G, response_times, station, agency_id):
-    
-    # initialize the geodataframe
-    station_polygons = gpd.GeoDataFrame()
-    
-    # Fetch the station's nearest node
-    station_tuple = (station.y, station.x)
-    station_node = ox.get_nearest_node(G, point=station_tuple, method='euclidean')
-
-    # Iterate over response times bins for that station
-    for i in range(len(response_times)):
-        response_time = response_times[i]
-
-        # Create the subgraph for the station and the response time
-        subgraph = nx.ego_graph(G, station_node, radius=response_time, distance='travel_time')
-
-        node_points_coords = [Point((data['lon'], data['lat'])) for node, data in subgraph.nodes(data=True)]
-        
-        # Old code for convex polygons
-        # bounding_poly_coords = gpd.GeoSeries(node_points_coords).unary_union.convex_hull
-        
-        # Make list of nodes into GeoSeries multi-point
-        multi_point = gpd.GeoSeries(node_points_coords).unary_union
-        # Create a concave hull polygon from the multi-point
-        concave_hull = alphashape.alphashape(multi_point, 50)
-        # Convert back to a GeoSeries then to a GeoDataFrame
-        bounding_poly_coords = gpd.GeoSeries(concave_hull)
-        poly_as_gdf = gpd.GeoDataFrame([bounding_poly_coords])
-        
-        # Rename the geometry column appropriately
-        poly_as_gdf.columns = ['geometry']
-        
-        # Add the response time column
-        poly_as_gdf['response_time'] = response_time
-
-        # Add the agency id column
-        poly_as_gdf['FIRE_AgencyId'] = agency_id
-        
-        # Append the polygon for that station to our GeoDataFrame
-        station_polygons = station_polygons.append(poly_as_gdf)
+# given the lon/lat coordinates of the nodes and their arrival times (in seconds).
+# Nodes that were not reached have an infinite arrival time.
+# The raster backend also needs the CSRGraph the arrival times were computed on.
+def make_polygons(lon, lat, arrival_times, response_times, agency_id, hull_backend=HULL_BACKEND,
+        csr_graph=None, cell_size=RASTER_CELL_SIZE):
+
+    # The built-in backend triangulates the nodes once and derives every bin from it,
+    # and the raster backend traces every bin from a single grid
+    if hull_backend == "triangulation":
+        concave_hulls = nested_alpha_shapes(lon, lat, arrival_times, response_times, ALPHA)
+    elif hull_backend == "raster":
+        concave_hulls = raster_isochrones(csr_graph, arrival_times, response_times, cell_size)
+    else:
+        concave_hulls = []
+
+        # Iterate over response times bins for that station
+        for response_time in response_times:
+
+            # Select the nodes reached within the response time
+            reached = arrival_times <= response_time
+            node_points_coords = [Point(coords) for coords in zip(lon[reached], lat[reached])]
+            
+            # Old code for convex polygons
+            # bounding_poly_coords = gpd.GeoSeries(node_points_coords).unary_union.convex_hull
+            
+            # Make list of nodes into GeoSeries multi-point
+            multi_point = gpd.GeoSeries(node_points_coords).unary_union
+            # Create a concave hull polygon from the multi-point
+            concave_hulls.append(alphashape.alphashape(multi_point, ALPHA))
+
+    # Build the GeoDataFrame in one go, with the response time and agency id columns
+    station_polygons = gpd.GeoDataFrame({'geometry': concave_hulls,
+        'response_time': list(response_times), 'FIRE_AgencyId': agency_id}, crs="EPSG:4326")
 
     # Return the GeoDataFrame containing polygon bins for the station
     return station_polygons
 
 
-########################################
-
-if __name__ == "__main__":
+# Returns a GeoDataFrame containing polygon geometries and a response time column
+# given the graph node the station was snapped to
+def compute_subgraphs(G, response_times, station_node, agency_id, hull_backend=HULL_BACKEND):
+
+    # Run a single shortest-path expansion out to the largest response time.
+    # Every reached node is stored with its arrival time (in seconds), so the
+    # smaller bins can be read off directly instead of re-running Dijkstra per bin.
+    arrival_times = nx.single_source_dijkstra_path_length(G, station_node,
+        cutoff=max(response_times), weight='travel_time')
+
+    reached_nodes = list(arrival_times)
+    lon = np.array([G.nodes[node]['lon'] for node in reached_nodes])
+    lat = np.array([G.nodes[node]['lat'] for node in reached_nodes])
+    times = np.array([arrival_times[node] for node in reached_nodes])
+
+    return make_polygons(lon, lat, times, response_times, agency_id, hull_backend)
+
+
+# Runs a single multi-source Dijkstra search on the NetworkX graph, seeded from every
+# station node at once, up to `cutoff` seconds. Returns two dictionaries keyed by node:
+# the arrival time from the closest station, and the position of that station in station_nodes.
+def first_due_labels(G, station_nodes, cutoff):
+    arrival_times = {}
+    labels = {}
+    # Heap entries are (arrival time, station position, node) so ties are broken
+    # in favour of the station listed first
+    heap = [(0, position, node) for position, node in enumerate(station_nodes)]
+    heapq.heapify(heap)
+    while heap:
+        arrival_time, position, node = heapq.heappop(heap)
+        if node in arrival_times:
+            continue
+        arrival_times[node] = arrival_time
+        labels[node] = position
+        for _, neighbor, travel_time in G.out_edges(node, data='travel_time'):
+            neighbor_time = arrival_time + travel_time
+            if neighbor not in arrival_times and neighbor_time <= cutoff:
+                heapq.heappush(heap, (neighbor_time, position, neighbor))
+    return arrival_times, labels
+
+
+# Returns a GeoDataFrame of non-overlapping first-due polygons (one per FIRE_AgencyId
+# and response time) given the arrival time of every node from its closest station
+# and the position of that station (-1 for unreached nodes) in station_agency_ids.
+def make_first_due_polygons(lon, lat, arrival_times, labels, station_agency_ids, response_times,
+        hull_backend=HULL_BACKEND, csr_graph=None, cell_size=RASTER_CELL_SIZE):
+    station_agency_ids = np.asarray(station_agency_ids)
+    node_agency_ids = np.where(labels >= 0, station_agency_ids[np.maximum(labels, 0)], None)
+
+    # Build each agency's polygons from the nodes for which it is first due
+    agency_gdfs = []
+    for agency_id in sorted(set(station_agency_ids)):
+        first_due = node_agency_ids == agency_id
+        if not first_due.any():
+            continue
+        # The raster backend needs an arrival time for every node of the graph
+        if hull_backend == "raster":
+            agency_gdfs.append(make_polygons(lon, lat, np.where(first_due, arrival_times, np.inf),
+                response_times, agency_id, hull_backend, csr_graph, cell_size))
+        else:
+            agency_gdfs.append(make_polygons(lon[first_due], lat[first_due], arrival_times[first_due],
+                response_times, agency_id, hull_backend))
+    polygons = pd.concat(agency_gdfs, ignore_index=True)
+
+    # The concave hulls of neighbouring agencies can still overlap slightly along their
+    # shared boundary: within each bin, remove the area already claimed by a previous agency
+    for response_time in response_times:
+        covered = None
+        for i in polygons.index[polygons['response_time'] == response_time]:
+            geometry = polygons.at[i, 'geometry']
+            if covered is not None:
+                polygons.at[i, 'geometry'] = geometry.difference(covered)
+                covered = covered.union(geometry)
+            else:
+                covered = geometry
+    return gpd.GeoDataFrame(polygons, geometry='geometry')
+
+
+# Returns a GeoDataFrame containing the polygon geometries of a station, one per response
+# time bin, with the shortest-path search restricted to the graph nodes within zone_area
+# (the station's Emergency Service Zone plus a margin, in the graph CRS). The polygons are
+# not bounded by the zone yet (see analysis_by_esn.clip_to_zones), so that bins left empty
+# by the clipping still have a polygon in the isochrone cache.
+def compute_esn_subgraphs(csr_graph, response_times, station_index, agency_id, zone_area,
+        hull_backend=HULL_BACKEND, cell_size=RASTER_CELL_SIZE):
+    allowed = csr_graph.nodes_within(zone_area)
+    allowed[station_index] = True
+    arrival_times = csr_graph.restricted_arrival_times(station_index, allowed, limit=max(response_times))
+
+    return make_polygons(csr_graph.lon, csr_graph.lat, arrival_times, response_times,
+        agency_id, hull_backend, csr_graph, cell_size)
+
+
+# Objects shared with the worker processes of the parallel mode (see __main__)
+_shared = {}
+
+# Returns the GeoDataFrame of response polygons for the i-th station, using the
+# graph and stations stored in _shared
+def station_polygons(i):
+    # Find the station's Fire Agency ID
+    agency_id = _shared['stations']['FIRE_AgencyId'].loc[i]
+
+    # Reuse the polygons computed by a previous run if the station's inputs are unchanged
+    key = _shared['station_keys'][i]
+    station_gdf = None
+    if key is not None:
+        cached_polygons = load_station_polygons(_shared['station_cache_path'], key)
+        if cached_polygons is not None:
+            station_gdf = gpd.GeoDataFrame({'geometry': cached_polygons, 'response_time': RESPONSE_TIMES,
+                'FIRE_AgencyId': agency_id}, crs="EPSG:4326")
+
+    # Returns a GeoDataFrame with columns "response_time" and "geometry"
+    # where the geometry column contains the response time polygons
+    if station_gdf is None:
+        if _shared['mode'] == "esn":
+            station_gdf = compute_esn_subgraphs(_shared['csr_graph'], RESPONSE_TIMES,
+                _shared['station_indices'][i], agency_id, _shared['zone_areas'][agency_id],
+                _shared['hull_backend'], _shared['cell_size'])
+        elif _shared['engine'] == "csr":
+            station_gdf = make_polygons(_shared['lon'], _shared['lat'],
+                _shared['arrival_times'][_shared['arrival_rows'][i]], RESPONSE_TIMES, agency_id,
+                _shared['hull_backend'], _shared['csr_graph'], _shared['cell_size'])
+        else:
+            station_gdf = compute_subgraphs(_shared['G'], RESPONSE_TIMES, _shared['station_nodes'][i],
+                agency_id, _shared['hull_backend'])
+
+        # Store the polygons as soon as they are computed, so an interrupted run can resume
+        if key is not None:
+            save_station_polygons(_shared['station_cache_path'], key, list(station_gdf['geometry']))
+
+    # The esn mode polygons (cached with one polygon per bin) are bounded by their zone here
+    if _shared['mode'] == "esn":
+        station_gdf = clip_to_zones(station_gdf, _shared['zones'])
+    return station_gdf
+
+
+# Returns the paths of the files written in the given analysis mode (with or without --esn)
+def output_paths(mode, esn):
+    minutes = [str(int(response_time/60)) for response_time in RESPONSE_TIMES]
+    if mode == "first-due":
+        return ["data/%s_first_due.geojson" % minute for minute in minutes]
+    paths = []
+    if mode == "station":
+        paths += ["data/%s.geojson" % minute for minute in minutes]
+    if esn or mode == "esn":
+        paths += ["data/%s_esn.geojson" % minute for minute in minutes] + ["data/esn_zones.geojson"]
+    return paths
+
+
+# Writes the polygons of every station to one geoJson file per response time
+# (to be read by Leaflet), given an iterable of per-station GeoDataFrames.
+# The polygons are streamed to the files as the GeoDataFrames are produced.
+# If the dissolved service zones are given (see analysis_by_esn.prepare_zones), the
+# polygons are also bounded by their zone and written to the ESN files in the same pass.
+def write_station_polygons(station_gdfs, response_times, path_format="data/%s.geojson",
+        zones=None, esn_path_format="data/%s_esn.geojson"):
+    with ExitStack() as stack:
+        writers = [stack.enter_context(GeoJSONWriter(path_format % str(int(response_time/60))))
+            for response_time in response_times]
+        esn_writers = []
+        if zones is not None:
+            esn_writers = [stack.enter_context(GeoJSONWriter(esn_path_format % str(int(response_time/60))))
+                for response_time in response_times]
+
+        # Filter through rows in station_gdf by response_time and write them to the corresponding file
+        for station_gdf in station_gdfs:
+            for writer, response_time in zip(writers, response_times):
+                rows = station_gdf.loc[station_gdf['response_time'] == response_time]
+                writer.write_frame(rows, ['response_time', 'FIRE_AgencyId'])
+
+            if zones is not None:
+                bounded_gdf = clip_to_zones(station_gdf, zones)
+                for writer, response_time in zip(esn_writers, response_times):
+                    rows = bounded_gdf.loc[bounded_gdf['response_time'] == response_time]
+                    writer.write_frame(rows, ['response_time', 'FIRE_AgencyId'])
+
+
+# Runs this stage given its command line arguments (read from sys.argv if None).
+# Also called in-process by pipeline.py.
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the response time polygons for every fire station.")
+    parser.add_argument("--engine", choices=ROUTING_ENGINES, default=ROUTING_ENGINE,
+        help="routing engine used to compute the station arrival times")
+    parser.add_argument("--mode", choices=ANALYSIS_MODES, default=ANALYSIS_MODE,
+        help="per-station response polygons, non-overlapping first-due polygons, or polygons "
+            "routed within each station's service zone only")
+    parser.add_argument("--hull", choices=HULL_BACKENDS, default=HULL_BACKEND,
+        help="backend used to build the polygon of the reached nodes")
+    parser.add_argument("--cell-size", type=float, default=RASTER_CELL_SIZE,
+        help="grid cell size (in meters) of the raster backend")
+    parser.add_argument("--no-cache", action="store_true",
+        help="recompute every station instead of reusing the polygons of previous runs")
+    parser.add_argument("--esn", action="store_true",
+        help="also write the polygons bounded by the emergency service zones (see analysis_by_esn.py)")
+    parser.add_argument("--esn-margin", type=float, default=ESN_MARGIN,
+        help="distance (in meters) around the service zone searched in the esn mode")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+        help="number of worker processes used to compute the station polygons")
+    parser.add_argument("--osm-file",
+        help="build the graph from a local OpenStreetMap extract (.osm or .osm.pbf, see osm_extract.py) "
+            "instead of downloading it")
+    args = parser.parse_args(argv)
+    if args.hull == "raster" and args.engine != "csr" and args.mode != "esn":
+        parser.error("the raster backend requires --engine csr")
+
+    # Skip the whole stage if its inputs and options did not change since the last run
+    # (the number of workers and the polygon cache do not change the output files)
+    stage_inputs = INPUT_FILES + SOURCE_FILES + ([args.osm_file] if args.osm_file else [])
+    stage_params = {key: value for key, value in vars(args).items() if key not in ["workers", "no_cache"]}
+    if stage_is_current("network_analysis", stage_inputs, stage_params):
+        print("Stations, zones and options are unchanged, skipping")
+        return
     
     # Read in station coordinate data
-    stations = gpd.read_file("data/updated_stations_coords.geojson")
+    stations = read_intermediate("updated_stations_coords")
     
     # Read in the bounding zone to be used for the graph
-    bounding_zone = gpd.read_file("data/vermont_state_polygon.geojson")["geometry"].loc[0]
+    bounding_zone = read_intermediate("vermont_state_polygon")["geometry"].loc[0]
     print("Making graph...")
 
     # Read in the emergency service zones to be used for subgraphs
-    zone_polygons = gpd.read_file("data/zone_polygons.geojson")
+    zone_polygons = read_intermediate("zone_polygons")
 
-    # Store the Vermont graph in a .graphml file so we don't need to recompute
-    # it every time from the geoJson
-    if not os.path.exists("vermont_graph.graphml"):
-        G = make_graph(bounding_zone)
-        ox.save_graphml(G, "vermont_graph.graphml")
-    else:
-        G = ox.load_graphml("vermont_graph.graphml")
+    # The Vermont graph is stored in a binary cache so we don't need to recompute it every time
+    # (esn mode always routes on the CSR graph, whatever the engine)
+    csr_graph, G = load_graph(bounding_zone, args.osm_file)
+    if G is None and args.engine == "networkx" and args.mode != "esn":
+        G = csr_graph.to_networkx()
 
     print("Vermont graph made!")
     
     # Project the station nodes to the same CRS as that of the Graph
-    stations = ox.projection.project_gdf(stations, to_crs=G.graph['crs'], to_latlong=False)
-
-    # List of dataframes for each response time
-    gdf_list = []
-
-    # Initialize as many GeoDataFrames as there are response time bins
-    # Store these new GeoDataFrames in the gdf_list array.
-    for i in range(len(RESPONSE_TIMES)):
-        gdf_list.append(gpd.GeoDataFrame())
+    stations = ox.projection.project_gdf(stations, to_crs=csr_graph.crs, to_latlong=False)
 
     # We need to add a Fire_AgencyId column to the fire stations dataset so that 
     # our response time geojson files can also contain this column.
@@ -153,28 +469,125 @@ if __name__ == "__main__":
         station_agency_id = zone_polygons.loc[station_esn == zone_polygons["ESN"], ["FIRE_AgencyId"]].values[0][0]
         stations.loc[stations.index[i], "FIRE_AgencyId"] = station_agency_id
 
-    # Iterate over every station
-    for i in tqdm(range(len(stations))):
-
-        # Select the station Point object to be passed as a param to compute_subgraphs()
-        station_of_interest = stations['geometry'].loc[i]
-
-        # Find the station's Fire Agency ID
-        agency_id = stations['FIRE_AgencyId'].loc[i]
+    # Snap every station to its nearest graph node in a single spatial index query
+    station_indices, snap_distances = csr_graph.snap(stations['geometry'].x, stations['geometry'].y)
+    station_nodes = csr_graph.node_ids[station_indices]
+
+    # Report the stations that are far away from the road network
+    for i in np.flatnonzero(snap_distances > SNAP_WARNING_DISTANCE):
+        print("Warning: station at %s is %d meters away from its nearest node"
+            % (stations['PRIMARYADDRESS'].loc[i], snap_distances[i]))
+
+    # In first-due mode, a single multi-source search labels every node with its closest station
+    if args.mode == "first-due":
+        print("Computing first-due areas...")
+        if args.engine == "csr":
+            lon, lat = csr_graph.lon, csr_graph.lat
+            routing_graph = contract_graph(csr_graph, station_indices)
+            arrival_times, labels = routing_graph.first_due(station_indices, limit=max(RESPONSE_TIMES))
+        else:
+            node_times, node_labels = first_due_labels(G, station_nodes, max(RESPONSE_TIMES))
+            reached_nodes = list(node_times)
+            lon = np.array([G.nodes[node]['lon'] for node in reached_nodes])
+            lat = np.array([G.nodes[node]['lat'] for node in reached_nodes])
+            arrival_times = np.array([node_times[node] for node in reached_nodes])
+            labels = np.array([node_labels[node] for node in reached_nodes])
+
+        first_due_gdf = make_first_due_polygons(lon, lat, arrival_times, labels,
+            stations['FIRE_AgencyId'].values, RESPONSE_TIMES, args.hull, csr_graph, args.cell_size)
+
+        write_station_polygons([first_due_gdf], RESPONSE_TIMES, "data/%s_first_due.geojson")
+        record_stage("network_analysis", stage_inputs, output_paths(args.mode, args.esn), stage_params)
+        return
+
+    # The ESN-bounded polygons are produced from the in-memory polygons (with --esn) or
+    # computed directly (esn mode), instead of having analysis_by_esn.py read files back
+    zones = None
+    if args.esn or args.mode == "esn":
+        zones = prepare_zones(zone_polygons)
+        zones.to_file("data/esn_zones.geojson", driver="GeoJSON")
+
+    # Key every station's polygons by everything they depend on, so that stations
+    # computed by a previous (possibly interrupted) run are not computed again
+    station_cache_path = None
+    if args.no_cache:
+        station_keys = [None] * len(stations)
+    else:
+        version = graph_version(csr_graph)
+        station_cache_path = open_station_cache(ISOCHRONE_CACHE_PATH, version)
+        hull_params = {'engine': args.engine, 'backend': args.hull, 'alpha': ALPHA,
+            'cell_size': args.cell_size, 'mode': args.mode}
+        station_params = [hull_params] * len(stations)
+
+        # In esn mode, the search is also bounded by the station's zone, and always
+        # runs on the CSR graph (so the engine does not change the polygons)
+        if args.mode == "esn":
+            del hull_params['engine']
+            hull_params['esn_margin'] = args.esn_margin
+            zone_hashes = {agency_id: hashlib.sha256(zone.wkb).hexdigest()
+                for agency_id, zone in zip(zones["FIRE_AgencyId"], zones["geometry"])}
+            station_params = [dict(hull_params, agency_id=agency_id, zone=zone_hashes.get(agency_id))
+                for agency_id in stations["FIRE_AgencyId"]]
+        station_keys = [station_key(node, RESPONSE_TIMES, params, version)
+            for node, params in zip(station_nodes, station_params)]
+    missing = [i for i in range(len(stations))
+        if station_keys[i] is None or not has_station_polygons(station_cache_path, station_keys[i])]
+    print("%d of %d stations need to be computed" % (len(missing), len(stations)))
+
+    # In esn mode, every station only searches its own zone plus a margin
+    if args.mode == "esn":
+        projected_zones = zones.to_crs(csr_graph.crs)
+        _shared['zones'] = zones
+        _shared['zone_areas'] = dict(zip(projected_zones["FIRE_AgencyId"],
+            projected_zones.buffer(args.esn_margin)))
+        _shared['station_indices'] = station_indices
+
+    # With the CSR engine, route every station that is not cached in a single batch call up front
+    elif args.engine == "csr":
+        # (the graph is only contracted when there is a station to route)
+        routing_graph = contract_graph(csr_graph, station_indices) if missing else csr_graph
+        station_arrival_times = routing_graph.arrival_times(station_indices[missing], limit=max(RESPONSE_TIMES))
+
+    # Share the graph and stations with station_polygons(). Worker processes are forked
+    # after this point, so they inherit these objects copy-on-write instead of
+    # receiving a pickled copy of the graph with every task.
+    _shared['mode'] = args.mode
+    _shared['engine'] = args.engine
+    _shared['hull_backend'] = args.hull
+    _shared['cell_size'] = args.cell_size
+    _shared['stations'] = stations
+    _shared['station_keys'] = station_keys
+    _shared['station_cache_path'] = station_cache_path
+    _shared['csr_graph'] = csr_graph
+    if args.engine == "csr" and args.mode != "esn":
+        _shared['lon'] = csr_graph.lon
+        _shared['lat'] = csr_graph.lat
+        _shared['arrival_times'] = station_arrival_times
+        _shared['arrival_rows'] = {i: row for row, i in enumerate(missing)}
+    elif args.mode != "esn":
+        _shared['G'] = G
+        _shared['station_nodes'] = station_nodes
+
+    # The esn mode polygons are already bounded by their zone and only go to the ESN files
+    if args.mode == "esn":
+        path_format, zones = "data/%s_esn.geojson", None
+    else:
+        path_format = "data/%s.geojson"
+
+    # Compute the polygons of every station, in parallel if several workers are requested,
+    # and stream them to the geoJson files as they are produced. Pool.imap returns the
+    # results in station order, so the output files are identical to those of a serial run.
+    if args.workers > 1:
+        with multiprocessing.get_context("fork").Pool(args.workers) as pool:
+            write_station_polygons(tqdm(pool.imap(station_polygons, range(len(stations))),
+                total=len(stations)), RESPONSE_TIMES, path_format, zones=zones)
+    else:
+        write_station_polygons(tqdm(map(station_polygons, range(len(stations))),
+            total=len(stations)), RESPONSE_TIMES, path_format, zones=zones)
 
-        # Returns a GeoDataFrame with columns "response_time" and "geometry"
-        # where the geometry column contains the response time polygons
-        station_gdf = compute_subgraphs(G, RESPONSE_TIMES, station_of_interest, agency_id)
+    record_stage("network_analysis", stage_inputs, output_paths(args.mode, args.esn), stage_params)
 
-        # Filter through rows in station_gdf by response_time and append to corresponding GeoDataFrame()
-        for j in range(len(RESPONSE_TIMES)):
-            row = station_gdf.loc[
-                (station_gdf['response_time'] == RESPONSE_TIMES[j]), 
-                ['response_time', 'FIRE_AgencyId', 'geometry']
-            ]
-            gdf_list[j] = gdf_list[j].append(row)
+########################################
 
-    # Convert each of the response time GeoDataFrames to geoJson files to be read by Leaflet
-    for i in range(len(gdf_list)):
-        response_min = int(RESPONSE_TIMES[i]/60)
-        gdf_list[i].to_file("data/%s.geojson" % str(response_min), driver="GeoJSON")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Osm_extract.py builds the road network graph from a local OpenStreetMap extract
+(e.g. vermont-latest.osm.pbf from https://download.geofabrik.de/north-america/us.html)
+instead of downloading it from the Overpass API, which is slow, rate-limited and not
+reproducible from one run to the next.
+
+The extract is read in a streaming pass (the whole file is never loaded in memory), keeping
+only the ways of the requested network type, filtered exactly like the Overpass query of
+osmnx.graph_from_polygon(). The graph is then assembled, simplified, truncated to the
+bounding polygon and reduced to its largest connected component the same way osmnx does,
+so that network_analysis.make_graph() can project it and add the speeds as usual.
+
+Both the .osm XML format and the (much smaller) .osm.pbf format are supported. Reading
+.osm.pbf files requires the osmium package (pip install osmium).
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import re
+import xml.etree.ElementTree as ET
+import numpy as np
+import networkx as nx
+import osmnx as ox
+
+# Ways excluded from each network type, as tag -> pattern searched in the tag's value
+# (the same filters as the Overpass queries of osmnx). Ways without a highway tag are
+# always excluded.
+NETWORK_FILTERS = {
+    "drive_service": {
+        "area": "yes",
+        "access": "private",
+        "highway": "abandoned|bridleway|bus_guideway|construction|corridor|cycleway|elevator|"
+            "escalator|footway|no|path|pedestrian|planned|platform|proposed|raceway|razed|steps|track",
+        "motor_vehicle": "no",
+        "motorcar": "no",
+        "service": "emergency_access|parking|parking_aisle|private",
+    },
+}
+
+# Earth radius (in meters) used to compute the edge lengths, same as osmnx
+EARTH_RADIUS = 6371009
+
+
+# Returns a function telling whether a way (given its tags) belongs to the network type
+def way_filter(network_type):
+    if network_type not in NETWORK_FILTERS:
+        raise ValueError("Unsupported network type for OSM extracts: %s" % network_type)
+    excluded = {key: re.compile(pattern) for key, pattern in NETWORK_FILTERS[network_type].items()}
+
+    def keep_way(tags):
+        if "highway" not in tags:
+            return False
+        return not any(key in tags and pattern.search(tags[key]) for key, pattern in excluded.items())
+    return keep_way
+
+
+# Returns the ways of an .osm XML file kept by keep_way(), as a list of
+# (way id, node ids, tags), and the lon/lat coordinates of their nodes (node id -> (lon, lat)).
+# The nodes come before the ways in the file, so it is read twice: once for the ways,
+# and once for the coordinates of their nodes only.
+def read_osm_xml(path, keep_way):
+    ways = []
+    for element in _iter_elements(path, "way"):
+        tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+        if keep_way(tags):
+            ways.append((int(element.get("id")), [int(nd.get("ref")) for nd in element.iter("nd")], tags))
+
+    needed = {node for _, node_ids, _ in ways for node in node_ids}
+    coordinates = {}
+    for element in _iter_elements(path, "node"):
+        node = int(element.get("id"))
+        if node in needed:
+            coordinates[node] = (float(element.get("lon")), float(element.get("lat")))
+    return ways, coordinates
+
+
+# Yields the elements of an .osm XML file with the given tag (node, way or relation).
+# Every element is discarded once it has been read, so memory use stays constant.
+def _iter_elements(path, element_tag):
+    context = ET.iterparse(path, events=("start", "end"))
+    _, root = next(context)
+    for event, element in context:
+        if event != "end" or element.tag not in ("node", "way", "relation"):
+            continue
+        if element.tag == element_tag:
+            yield element
+        root.clear()
+
+
+# Returns the ways of an .osm.pbf file kept by keep_way(), as a list of
+# (way id, node ids, tags), and the lon/lat coordinates of their nodes (node id -> (lon, lat)).
+# osmium keeps the locations of all the nodes while reading, so the file is only read once.
+def read_osm_pbf(path, keep_way):
+    # Only needed for .osm.pbf files
+    import osmium
+
+    class WayHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super().__init__()
+            self.ways = []
+            self.coordinates = {}
+
+        def way(self, way):
+            tags = {tag.k: tag.v for tag in way.tags}
+            if not keep_way(tags):
+                return
+            # Nodes outside of the extract have no location
+            for node in way.nodes:
+                if node.location.valid():
+                    self.coordinates[node.ref] = (node.location.lon, node.location.lat)
+            self.ways.append((way.id, [node.ref for node in way.nodes], tags))
+
+    handler = WayHandler()
+    handler.apply_file(path, locations=True)
+    return handler.ways, handler.coordinates
+
+
+# Returns the great-circle distances (in meters) between arrays of lon/lat coordinates
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+# Returns the unsimplified MultiDiGraph (in lon/lat) of the given ways, with one edge in each
+# direction between consecutive nodes of a way (the repository only uses bidirectional networks,
+# see ox.config in network_analysis.py) and their length in meters.
+# Edges with a node outside of the extract are dropped.
+def build_graph(ways, coordinates):
+    G = nx.MultiDiGraph(crs=ox.settings.default_crs)
+    for node, (lon, lat) in coordinates.items():
+        G.add_node(node, x=lon, y=lat)
+
+    u, v, way_index = [], [], []
+    for i, (_, node_ids, _) in enumerate(ways):
+        for start, end in zip(node_ids[:-1], node_ids[1:]):
+            if start != end and start in coordinates and end in coordinates:
+                u.append(start)
+                v.append(end)
+                way_index.append(i)
+
+    start_coords = np.array([coordinates[node] for node in u]).reshape(-1, 2)
+    end_coords = np.array([coordinates[node] for node in v]).reshape(-1, 2)
+    lengths = haversine(start_coords[:, 0], start_coords[:, 1], end_coords[:, 0], end_coords[:, 1])
+
+    # Same edge attributes as osmnx: the way id, its useful tags and the oneway flag
+    way_attributes = []
+    for way_id, _, tags in ways:
+        attributes = {key: tags[key] for key in ox.settings.useful_tags_way if key in tags}
+        attributes.update(osmid=way_id, oneway=False)
+        way_attributes.append(attributes)
+
+    for start, end, i, length in zip(u, v, way_index, lengths.tolist()):
+        G.add_edge(start, end, **way_attributes[i], length=length)
+        G.add_edge(end, start, **way_attributes[i], length=length)
+
+    G.remove_nodes_from([node for node in coordinates if G.degree(node) == 0])
+    return G
+
+
+# Returns the simplified MultiDiGraph (in lon/lat) of the network_type road network within
+# the polygon (in lon/lat), read from a local .osm or .osm.pbf extract
+def graph_from_osm_file(path, polygon, network_type="drive_service"):
+    keep_way = way_filter(network_type)
+    if path.endswith(".pbf"):
+        ways, coordinates = read_osm_pbf(path, keep_way)
+    else:
+        ways, coordinates = read_osm_xml(path, keep_way)
+    print("Read %d ways and %d nodes from %s" % (len(ways), len(coordinates), path))
+
+    G = build_graph(ways, coordinates)
+    G = ox.simplify_graph(G)
+
+    # Keep the nodes within the polygon, then the largest (weakly) connected component
+    G = ox.truncate.truncate_graph_polygon(G, polygon, retain_all=True)
+    return ox.utils_graph.get_largest_component(G)
@@ -0,0 +1,202 @@
+"""
+Pipeline.py runs the whole data generation pipeline in a single process:
+    python -m pipeline
+
+Every stage (one of the scripts run by the weekly workflow) is declared below with the
+files it reads and the files it writes. A stage depends on the stages writing one of its
+input files, and the stages that do not depend on each other (e.g. the hydrant stages and
+the network analysis) run at the same time, in separate threads.
+
+The stages run in-process: the intermediate files (see intermediates.py) and the road
+network graph (see network_analysis.load_graph) are kept in memory and shared between
+the stages instead of being read back from disk, and the heavy libraries are only
+imported once.
+
+A stage is skipped when all of its output files are newer than all of its input files
+(including its source files). The stages that do run may still skip their own work when
+the contents of their inputs did not change (see manifest.py).
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import os
+import time
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import produce_geojson
+import dept_type_to_json
+import match_departments
+import hydrants_coords_by_type
+import network_analysis
+import hydrant_analysis
+import hydrant_reach
+import coverage_stats
+from datasets import API_HYDRANTS_PATH, API_ZONES_PATH, API_STRUCTURES_PATH, API_VERMONT_PATH
+from intermediates import intermediate_path, keep_in_memory
+
+# Number of stages run at the same time
+JOBS = 4
+
+# A stage of the pipeline: the function running it, the files it reads (data and source files)
+# and writes, and the stages it must run after even though it does not read their files.
+# A stage without input files always runs.
+Stage = namedtuple("Stage", ["name", "run", "inputs", "outputs", "after"], defaults=[[]])
+
+# Hydrant types written by hydrants_coords_by_type.py (one intermediate file each)
+HYDRANT_TYPE_FILES = [hydrant_type.replace(" ", "_") for hydrant_type in hydrants_coords_by_type.hydrant_type_list]
+
+# Options of the network analysis stage: route all the stations at once on the contracted
+# CSR graph, and build every station's polygons from a single triangulation (see hulls.py)
+NETWORK_ARGS = ["--esn", "--engine", "csr", "--hull", "triangulation"]
+
+# Response time polygons written by network_analysis.py --esn
+NETWORK_OUTPUTS = network_analysis.output_paths("station", True)
+
+# Hydrant buffers written by hydrant_analysis.py
+HYDRANT_BUFFER_OUTPUTS = ["data/%s_buffers.geojson" % name for name in HYDRANT_TYPE_FILES]
+
+
+# Returns the stages of the pipeline, building the road network graph from the given
+# local OpenStreetMap extract (see osm_extract.py) instead of downloading it if not None
+def pipeline_stages(osm_file=None):
+    graph_args = ["--osm-file", osm_file] if osm_file is not None else []
+    graph_inputs = [osm_file] if osm_file is not None else []
+    return [
+        Stage("download", produce_geojson.download_data, [],
+            [API_HYDRANTS_PATH, API_ZONES_PATH, API_STRUCTURES_PATH, API_VERMONT_PATH]),
+        Stage("produce_geojson", produce_geojson.produce_files,
+            [API_HYDRANTS_PATH, API_ZONES_PATH, API_STRUCTURES_PATH, API_VERMONT_PATH,
+                "produce_geojson.py", "geojson_io.py", "intermediates.py"],
+            [intermediate_path(name) for name in
+                ["fire_station_coords", "vermont_state_polygon", "zone_polygons", "hydrant_coords"]]
+            + ["data/%s.geojson" % name for name in
+                ["fire_station_coords", "vermont_state_polygon", "zone_polygons", "hydrant_coords"]]),
+        # The data folder is created by the download stage
+        Stage("dept_type_to_json",
+            lambda: dept_type_to_json.csv_to_json(dept_type_to_json.csvFilePath, dept_type_to_json.jsonFilePath),
+            [dept_type_to_json.csvFilePath, "dept_type_to_json.py"], [dept_type_to_json.jsonFilePath],
+            after=["download"]),
+        Stage("match_departments", match_departments.main, match_departments.MATCH_INPUTS,
+            match_departments.MATCH_OUTPUTS),
+        Stage("hydrants_coords_by_type", hydrants_coords_by_type.main,
+            [intermediate_path("hydrant_coords"), "hydrants_coords_by_type.py"],
+            ["data/%s_coords.geojson" % name for name in HYDRANT_TYPE_FILES]
+            + [intermediate_path("%s_coords" % name) for name in HYDRANT_TYPE_FILES]),
+        Stage("network_analysis", lambda: network_analysis.main(NETWORK_ARGS + graph_args),
+            network_analysis.INPUT_FILES + network_analysis.SOURCE_FILES + graph_inputs, NETWORK_OUTPUTS),
+        Stage("hydrant_analysis", lambda: hydrant_analysis.main([]),
+            [intermediate_path("%s_coords" % name) for name in HYDRANT_TYPE_FILES]
+            + ["hydrant_analysis.py", "geojson_io.py", "intermediates.py"],
+            HYDRANT_BUFFER_OUTPUTS),
+        # The road network graph is cached by network_analysis.py
+        Stage("hydrant_reach", lambda: hydrant_reach.main(graph_args),
+            [intermediate_path("%s_coords" % name) for name in HYDRANT_TYPE_FILES]
+            + [intermediate_path("vermont_state_polygon"), os.path.join(network_analysis.GRAPH_CACHE_PATH, "meta.json"),
+                "hydrant_reach.py", "routing.py"] + graph_inputs,
+            ["data/%s_reach.geojson" % name for name in HYDRANT_TYPE_FILES], after=["network_analysis"]),
+        Stage("coverage_stats", coverage_stats.main,
+            [API_STRUCTURES_PATH, intermediate_path("zone_polygons"), "coverage_stats.py"]
+            + NETWORK_OUTPUTS + HYDRANT_BUFFER_OUTPUTS,
+            ["data/%s.%s" % (file_name, extension) for file_name in coverage_stats.GROUPINGS.values()
+                for extension in ["csv", "json"]]),
+    ]
+
+
+# Returns a dictionary of stage name -> set of names of the stages it depends on, i.e. the
+# stages writing one of its input files and the stages it must run after
+def stage_dependencies(stages):
+    writers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            writers[path] = stage.name
+    return {stage.name: {writers[path] for path in stage.inputs if path in writers} | set(stage.after)
+        for stage in stages}
+
+
+# Returns whether a stage can be skipped, i.e. all of its output files that exist (at least one)
+# are newer than all of its input files that exist. Some files are not always written
+# (e.g. no file is written for the hydrant types without any hydrant).
+def is_up_to_date(stage):
+    inputs = [path for path in stage.inputs if os.path.exists(path)]
+    outputs = [path for path in stage.outputs if os.path.exists(path)]
+    if not stage.inputs or not outputs:
+        return False
+    return min(os.path.getmtime(path) for path in outputs) > max(os.path.getmtime(path) for path in inputs)
+
+
+# Runs a stage unless it is up to date (or force is True), returns whether it was run
+def run_stage(stage, force=False):
+    if not force and is_up_to_date(stage):
+        print("[%s] outputs are up to date, skipping" % stage.name)
+        return False
+    print("[%s] running..." % stage.name)
+    start = time.time()
+    stage.run()
+    print("[%s] done in %.1f seconds" % (stage.name, time.time() - start))
+    return True
+
+
+# Runs the stages as soon as the stages they depend on are done, at most jobs at a time.
+# Once a stage fails, no other stage is started. Returns the name of the failed stage
+# (None if every stage succeeded).
+def run_pipeline(stages, jobs=JOBS, force=False):
+    dependencies = stage_dependencies(stages)
+    pending = {stage.name: stage for stage in stages}
+    unknown = {name for names in dependencies.values() for name in names} - set(pending)
+    if unknown:
+        raise ValueError("Unknown stages: %s" % ", ".join(sorted(unknown)))
+
+    done = set()
+    running = {}
+    failed = None
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            if failed is None:
+                for name in [name for name in pending if dependencies[name] <= done]:
+                    running[executor.submit(run_stage, pending.pop(name), force)] = name
+            if not running:
+                # Remaining stages can never run (a failure, or a dependency cycle)
+                if failed is None:
+                    raise ValueError("Dependency cycle between stages: %s" % ", ".join(pending))
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                # Scripts exit on errors (e.g. a failed download), which is caught here as well
+                error = future.exception()
+                if error is None:
+                    done.add(name)
+                elif failed is None:
+                    print("[%s] failed: %r" % (name, error))
+                    failed = name
+    return failed
+
+
+# Runs the pipeline given its command line arguments (read from sys.argv if None)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run every stage of the data generation pipeline.")
+    parser.add_argument("--jobs", type=int, default=JOBS,
+        help="number of stages run at the same time")
+    parser.add_argument("--force", action="store_true",
+        help="run every stage, even when its outputs are newer than its inputs")
+    parser.add_argument("--osm-file",
+        help="build the road network graph from a local OpenStreetMap extract (.osm or .osm.pbf) "
+            "instead of downloading it")
+    args = parser.parse_args(argv)
+
+    # Share the intermediate files between the stages instead of reading them back
+    keep_in_memory()
+
+    start = time.time()
+    failed = run_pipeline(pipeline_stages(args.osm_file), args.jobs, args.force)
+    if failed is not None:
+        print("Pipeline stopped, %s failed" % failed)
+        exit(1)
+    print("Pipeline done in %.1f seconds" % (time.time() - start))
+
+########################################
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,21 @@
 Produce_geojson.py takes as input the raw .json data files fetched from the Vermont
 Open Geodata Portal API by datasets.py
 It filters and parses this data to preserve only relevant information.
-The following .geojson files are then output:
-- hydrant_coords.geojson
-- fire_station_coords.geojson
-- vermont_state_polygon.geojson
-- zone_polygons.geojson (contains general state emergency service zones; 
-  Fire Dept. zones are later created in analysis_by_esn.py and zone_polygons.geojson
+The following intermediate files are then output (see intermediates.py), along with
+the geoJson file of the same name read by the website:
+- hydrant_coords
+- fire_station_coords
+- vermont_state_polygon
+- zone_polygons (contains general state emergency service zones; 
+  Fire Dept. zones are later created in analysis_by_esn.py and zone_polygons
   does not represent the Fire Dept. zones yet)
 
 These files are then ingested into the network_analysis.py file to compute response times
 from every fire station. The fire hydrants are processed in hydrant_analysis.py.
 
+A file is only produced again when its input dataset (or this file) changed since the
+last run (see manifest.py).
+
 All data files are written to the data folder of the project Website directory and
 may be downloaded from there: https://github.com/This-blank-Is-On-Fire/Website
 
@@ -21,18 +25,23 @@ Authors: Halcyon Brown & John Cambefort
 
 import os
 import geopandas as gpd
+import pandas as pd
+from geojson_io import read_features
+from intermediates import intermediate_path, write_intermediate
 from datasets import API_HYDRANTS_PATH, API_ZONES_PATH, API_STRUCTURES_PATH, API_VERMONT_PATH, request_API_data
+from manifest import stage_is_current, record_stage
 
 # Creates a 5-column geojson file containing fire hydrant coordinates, county, hydrant ID, 
 # hydrant type and flow rate from a json file collected from the Vermont Geoportal API
 # Returns the GeoDataFrame (used to generate the output .geojson file)
 def hydrants_to_geojson(output_file_name, input_file_path):
     hydrant_path = input_file_path
-    gdf = gpd.read_file(hydrant_path)
-    hydrant_coords = gdf[["COUNTY", "HYDRANTID", "HYDRANTTYPE", "FLOWRATE", "geometry"]]
+    # Only read the required columns
+    hydrant_coords = read_features(hydrant_path, columns=["COUNTY", "HYDRANTID", "HYDRANTTYPE", "FLOWRATE"])
 
     print("Outputting %s.geojson..." % output_file_name)
     hydrant_coords.to_file("data/%s.geojson" % output_file_name, driver="GeoJSON")
+    write_intermediate(hydrant_coords, output_file_name)
     #hydrant_coords.to_file("%s_test.geojson" % output_file_name, driver="GeoJSON")
     return hydrant_coords
 
@@ -58,6 +67,7 @@ def zone_to_geojson(output_file_name, input_file_path):
 
     print("Outputting %s.geojson..." % output_file_name)
     zone_polygons.to_file("data/%s.geojson" % output_file_name, driver="GeoJSON")
+    write_intermediate(zone_polygons, output_file_name)
     #zone_polygons.to_file("%s_test.geojson" % output_file_name, driver="GeoJSON")
 
     return zone_polygons
@@ -68,29 +78,44 @@ def zone_to_geojson(output_file_name, input_file_path):
 # Returns the GeoDataFrame (used to generate the output .geojson file)
 def stations_to_geojson(output_file_name, input_file_path):
     structure_data = input_file_path
-    gdf = gpd.read_file(structure_data)
-    
-    # Geodataframe that includes all structures with SITETYPE = FIRE STATION
-    station_coords = gdf.loc[gdf["SITETYPE"].str.contains("FIRE STATION"),
-        ["PRIMARYADDRESS", "TOWNNAME", "ESN", "SITETYPE", "geometry"]]
-    
-    # Geodataframe that includes all missing fire departments that have alternative SITETYPEs
-    missing_station_coords = gpd.GeoDataFrame()
+    columns = ["PRIMARYADDRESS", "TOWNNAME", "ESN", "SITETYPE"]
 
+    # All missing fire departments that have alternative SITETYPEs
     missing_station_addresses = {"15 FOURTH ST": "LAW ENFORCEMENT", "170 ROCKINGHAM ST": "GOVERNMENT", "5 N PARK PL": "TOWN OFFICE", "2996 VT ROUTE 78": "TOWN OFFICE", "68 TOWN OFFICE RD": "GOVERNMENT",
         "37 DANE RD": "TOWN OFFICE", "1996 BLACKMER BLVD": "TOWN GARAGE", "350 S MAIN ST": "LAW ENFORCEMENT", "29 UNION ST": "LAW ENFORCEMENT", "48 MAIN ST": "AMBULANCE SERVICE", "1187 MAIN ST": "LAW ENFORCEMENT", 
         "120 FIRST ST": "LAW ENFORCEMENT", "46 TOWN GARAGE RD": "TOWN GARAGE", "12 ROUTE 215": "GOVERNMENT"}
-    for key in missing_station_addresses:
-        site_type = missing_station_addresses[key]
-        missing_station_gdf = gdf.loc[(gdf["PRIMARYADDRESS"].str.contains(key)) & (gdf["SITETYPE"].str.contains(site_type)),
-        ["PRIMARYADDRESS", "TOWNNAME", "ESN", "SITETYPE", "geometry"]]
-        missing_station_coords = missing_station_coords.append(missing_station_gdf)
+
+    # Returns the position in missing_station_addresses of the missing station a structure
+    # corresponds to (None if it is not one of them)
+    def missing_station(properties):
+        address = properties.get("PRIMARYADDRESS") or ""
+        site_type = properties.get("SITETYPE") or ""
+        for position, key in enumerate(missing_station_addresses):
+            if key in address and missing_station_addresses[key] in site_type:
+                return position
+        return None
+
+    # Returns whether a structure is a fire station (SITETYPE = FIRE STATION) or one of the missing stations
+    def is_station(properties):
+        return "FIRE STATION" in (properties.get("SITETYPE") or "") or missing_station(properties) is not None
+
+    # Only the stations are read from the (very large) structures file
+    gdf = read_features(structure_data, where=is_station, columns=columns)
+
+    # Geodataframe that includes all structures with SITETYPE = FIRE STATION, followed by
+    # the missing fire departments (in the order of missing_station_addresses)
+    is_fire_station = gdf["SITETYPE"].fillna("").str.contains("FIRE STATION", regex=False)
+    missing_order = [missing_station(row) for row in gdf[columns].to_dict("records")]
+    station_coords = gdf.loc[is_fire_station]
+    missing_station_coords = gdf.loc[~is_fire_station].assign(order=pd.Series(missing_order, index=gdf.index))
+    missing_station_coords = missing_station_coords.sort_values("order", kind="stable").drop(columns="order")
 
     # Append the two dataframes together ie. stations.append(missing)
-    station_coords = station_coords.append(missing_station_coords)
+    station_coords = pd.concat([station_coords, missing_station_coords])
 
     print("Outputting %s.geojson..." % output_file_name)
     station_coords.to_file("data/%s.geojson" % output_file_name, driver="GeoJSON")
+    write_intermediate(station_coords, output_file_name)
     return station_coords
 
 
@@ -104,6 +129,7 @@ def vermont_to_geojson(output_file_name, input_file_path):
     
     print("Outputting %s.geojson..." % output_file_name)
     vermont_coords.to_file("data/%s.geojson" % output_file_name, driver="GeoJSON")
+    write_intermediate(gpd.GeoDataFrame(geometry=vermont_coords), output_file_name)
     return vermont_coords
 
 # # Creates a 2-column geojson file containing surface water polygons
@@ -130,21 +156,41 @@ def vermont_to_geojson(output_file_name, input_file_path):
 #     footprint_polygons.to_file("data/%s.geojson" % output_file_name, driver="GeoJSON")
 #     return footprint_polygons
 
-########################################
-
-if __name__ == "__main__":
 
+# Generates .json files collected from the GeoPortal API to be ingested by GeoPandas
+def download_data():
     # Make sure the data folder exists (where all json / geojsons are output)
     if not os.path.exists('data'):
         os.makedirs('data')
 
-    # Generate .json files collected from the GeoPortal API to be ingested by GeoPandas
     request_API_data()
 
-    # Create new .geojson files by filtering through JSON data for relevant columns
-    stations_to_geojson("fire_station_coords", API_STRUCTURES_PATH)
-    vermont_to_geojson("vermont_state_polygon", API_VERMONT_PATH)
-    zone_to_geojson("zone_polygons", API_ZONES_PATH)
-    hydrants_to_geojson("hydrant_coords", API_HYDRANTS_PATH)
+
+# Creates new files by filtering through JSON data for relevant columns,
+# skipping the files whose input dataset did not change
+def produce_files():
+    outputs = [(stations_to_geojson, "fire_station_coords", API_STRUCTURES_PATH),
+        (vermont_to_geojson, "vermont_state_polygon", API_VERMONT_PATH),
+        (zone_to_geojson, "zone_polygons", API_ZONES_PATH),
+        (hydrants_to_geojson, "hydrant_coords", API_HYDRANTS_PATH)]
+    for to_geojson, output_file_name, input_file_path in outputs:
+        stage = "produce_geojson:%s" % output_file_name
+        inputs = [input_file_path, "produce_geojson.py", "geojson_io.py", "intermediates.py"]
+        if stage_is_current(stage, inputs):
+            print("%s is up to date" % output_file_name)
+            continue
+        to_geojson(output_file_name, input_file_path)
+        record_stage(stage, inputs, [intermediate_path(output_file_name), "data/%s.geojson" % output_file_name])
     # surface_water_to_geojson("surface_water_polygons", API_SURFACE_WATER_PATH)
-    # footprints_to_geojson("footprint_polygons", API_FOOTPRINTS_PATH)
\ No newline at end of file
+    # footprints_to_geojson("footprint_polygons", API_FOOTPRINTS_PATH)
+
+
+# Runs this stage (also called in-process by pipeline.py)
+def main():
+    download_data()
+    produce_files()
+
+########################################
+
+if __name__ == "__main__":
+    main()
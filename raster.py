@@ -0,0 +1,121 @@
+"""
+Raster.py contains a raster-based alternative to the concave hull (alpha shape)
+polygons used by network_analysis.py.
+
+Instead of wrapping the reached nodes in a concave hull, arrival times are spread
+onto a regular grid in the graph's projected CRS:
+1. Points are sampled along every reached edge (as well as at the nodes), and their
+   arrival time is interpolated from the arrival times at the two edge ends.
+2. Every grid cell takes the arrival time of the nearest sample within
+   RASTER_SEARCH_RADIUS meters (cells further away from the roads are not reached).
+3. Every cell is labeled with the smallest response bin containing it, and all the
+   bins are traced from that single label grid: the polygon of a bin is the union of
+   the cells labeled with that bin or a smaller one, so the bands are always nested.
+
+The cost of this backend depends on the grid size (i.e. the cell size) rather than on
+the number and density of the reached nodes.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import numpy as np
+import geopandas as gpd
+from scipy.spatial import cKDTree
+from shapely.geometry import box
+from shapely.ops import unary_union
+
+# Size (in meters) of the grid cells
+RASTER_CELL_SIZE = 100
+
+# Cells further than this distance (in meters) from the nearest road sample are not reached
+RASTER_SEARCH_RADIUS = 300
+
+
+# Returns the coordinates and arrival times of points sampled along the edges of the
+# graph (and at its nodes) that are reached within `limit` seconds. Points are sampled
+# every `spacing` meters along the straight line between the two ends of an edge.
+def sample_edges(csr_graph, arrival_times, limit, spacing):
+    reached = arrival_times <= limit
+
+    # Edges with at least one reached end
+    u = np.repeat(np.arange(csr_graph.n_nodes), np.diff(csr_graph.indptr))
+    v = csr_graph.indices
+    keep = reached[u] | reached[v]
+    u, v, weights = u[keep], v[keep], csr_graph.travel_time[keep]
+
+    # Number of samples per edge (not counting its two ends)
+    lengths = np.hypot(csr_graph.x[v] - csr_graph.x[u], csr_graph.y[v] - csr_graph.y[u])
+    counts = np.maximum(np.ceil(lengths / spacing).astype(np.int64) - 1, 0)
+
+    # Fraction of the way along the edge of every sample
+    edge = np.repeat(np.arange(len(u)), counts)
+    first_sample = np.cumsum(counts) - counts
+    position = np.arange(len(edge)) - first_sample[edge] + 1
+    fraction = position / (counts[edge] + 1)
+
+    su, sv = u[edge], v[edge]
+    x = csr_graph.x[su] + fraction * (csr_graph.x[sv] - csr_graph.x[su])
+    y = csr_graph.y[su] + fraction * (csr_graph.y[sv] - csr_graph.y[su])
+    # A sample is reached from whichever end of the edge gets it there first
+    times = np.minimum(arrival_times[su] + fraction * weights[edge],
+        arrival_times[sv] + (1 - fraction) * weights[edge])
+
+    x = np.concatenate([csr_graph.x[reached], x])
+    y = np.concatenate([csr_graph.y[reached], y])
+    times = np.concatenate([arrival_times[reached], times])
+    return x, y, times
+
+
+# Returns the polygon covering the True cells of a boolean grid, given the coordinates
+# of the grid's lower left corner and its cell size
+def trace_cells(mask, x0, y0, cell_size):
+    # Merge the consecutive True cells of every row into a single rectangle
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    changes = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(changes == 1)
+    _, ends = np.nonzero(changes == -1)
+
+    boxes = [box(x0 + start * cell_size, y0 + row * cell_size,
+        x0 + end * cell_size, y0 + (row + 1) * cell_size)
+        for row, start, end in zip(rows, starts, ends)]
+    return unary_union(boxes)
+
+
+# Returns a list of polygons (in lon/lat), one per threshold (in the order of the thresholds),
+# covering the grid cells reached within each threshold, given the arrival time
+# (in seconds) at every node of the CSRGraph (infinity for nodes that were not reached).
+# The nested bins are built from the thresholds sorted in increasing order.
+def raster_isochrones(csr_graph, arrival_times, thresholds, cell_size=RASTER_CELL_SIZE,
+        search_radius=RASTER_SEARCH_RADIUS):
+    order = np.argsort(thresholds, kind='stable')
+    thresholds = np.asarray(thresholds)[order]
+    x, y, times = sample_edges(csr_graph, arrival_times, thresholds[-1], cell_size / 2)
+    inside = times <= thresholds[-1]
+    x, y, times = x[inside], y[inside], times[inside]
+
+    # Build the grid around the samples
+    x0 = x.min() - search_radius
+    y0 = y.min() - search_radius
+    n_columns = int(np.ceil((x.max() + search_radius - x0) / cell_size))
+    n_rows = int(np.ceil((y.max() + search_radius - y0) / cell_size))
+    column_centers = x0 + (np.arange(n_columns) + 0.5) * cell_size
+    row_centers = y0 + (np.arange(n_rows) + 0.5) * cell_size
+    centers_x, centers_y = np.meshgrid(column_centers, row_centers)
+
+    # Every cell takes the arrival time of its nearest sample
+    distances, nearest = cKDTree(np.column_stack((x, y))).query(
+        np.column_stack((centers_x.ravel(), centers_y.ravel())), distance_upper_bound=search_radius)
+    grid = np.full(n_rows * n_columns, np.inf)
+    found = np.isfinite(distances)
+    grid[found] = times[nearest[found]]
+    grid = grid.reshape(n_rows, n_columns)
+
+    # Label every cell with the index of the smallest bin containing it
+    # (len(thresholds) for cells that are not reached)
+    bands = np.searchsorted(thresholds, grid, side='left')
+
+    polygons = [None] * len(thresholds)
+    for i, threshold_index in enumerate(order):
+        polygons[threshold_index] = trace_cells(bands <= i, x0, y0, cell_size)
+    return list(gpd.GeoSeries(polygons, crs=csr_graph.crs).to_crs("EPSG:4326"))
@@ -0,0 +1,439 @@
+"""
+Routing.py contains an array-backed routing engine used by network_analysis.py as an
+alternative to walking the NetworkX graph directly.
+
+The graph produced by network_analysis.make_graph() is converted into compressed
+sparse row (CSR) arrays:
+- int32 node indices (the CSR `indptr` / `indices` arrays)
+- float32 `travel_time` edge weights (in seconds) and `length` edge lengths (in meters)
+- float64 x/y (projected) and lon/lat node coordinate arrays
+
+Shortest-path searches are then run with scipy's compiled Dijkstra implementation,
+for all the fire stations at once, instead of one Python-level search per station.
+
+The station searches run on a contracted copy of the graph (see ContractedGraph), without
+the dead ends and the inner nodes of the road chains, which most of the nodes are. The
+arrival times of the removed nodes are derived from those of the nodes kept.
+
+Authors: Halcyon Brown & John Cambefort
+"""
+
+import numpy as np
+import networkx as nx
+import geopandas as gpd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+# Smallest edge weight stored in the CSR arrays. scipy drops explicit zeros from
+# sparse matrices, so zero-length edges would otherwise disappear from the graph.
+MIN_EDGE_WEIGHT = 1e-3
+
+# Number of stations routed per call to scipy's dijkstra. Each call allocates a
+# (batch size x number of nodes) float64 array, so this bounds memory usage.
+BATCH_SIZE = 64
+
+
+# Returns the CSR arrays (indptr, indices, weights, lengths) for a graph with n nodes
+# given its edge arrays. Self loops are dropped, and only the smallest weight (and the
+# length of that edge) is kept for parallel edges between the same pair of nodes.
+def compress_edges(n, u, v, weights, lengths):
+    u = np.asarray(u, dtype=np.int64)
+    v = np.asarray(v, dtype=np.int64)
+    weights = np.maximum(np.asarray(weights, dtype=np.float32), MIN_EDGE_WEIGHT)
+    lengths = np.maximum(np.asarray(lengths, dtype=np.float32), MIN_EDGE_WEIGHT)
+
+    # Drop self loops, they can never shorten a path
+    keep = u != v
+    u, v, weights, lengths = u[keep], v[keep], weights[keep], lengths[keep]
+
+    # Sort the edges by source, target then weight, and keep the first
+    # (i.e. the fastest) edge of every (source, target) pair
+    order = np.lexsort((weights, v, u))
+    u, v, weights, lengths = u[order], v[order], weights[order], lengths[order]
+    first = np.ones(len(u), dtype=bool)
+    first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    u, v, weights, lengths = u[first], v[first], weights[first], lengths[first]
+
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(u, minlength=n), out=indptr[1:])
+    return indptr, v.astype(np.int32), weights, lengths
+
+
+# Compact, read-only copy of a projected road network graph.
+# Node i of the CSRGraph corresponds to the OSM node node_ids[i].
+class CSRGraph:
+
+    def __init__(self, node_ids, x, y, lon, lat, indptr, indices, travel_time, length=None, crs=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.travel_time = np.asarray(travel_time, dtype=np.float32)
+        # Fall back to the straight-line length of the edges if their length is not known
+        if length is None:
+            u = np.repeat(np.arange(len(self.node_ids)), np.diff(self.indptr))
+            length = np.maximum(np.hypot(self.x[self.indices] - self.x[u],
+                self.y[self.indices] - self.y[u]), MIN_EDGE_WEIGHT)
+        self.length = np.asarray(length, dtype=np.float32)
+        self.crs = crs
+        self._matrix = None
+        self._length_matrix = None
+        self._sorted_ids = None
+        self._tree = None
+
+    # Builds a CSRGraph from a projected NetworkX graph with `travel_time` and `length`
+    # edge attributes (i.e. the graph returned by network_analysis.make_graph())
+    @classmethod
+    def from_networkx(cls, G):
+        n = G.number_of_nodes()
+        node_ids = np.fromiter(G.nodes, dtype=np.int64, count=n)
+        position = {node: i for i, node in enumerate(G.nodes)}
+
+        x = np.empty(n)
+        y = np.empty(n)
+        lon = np.empty(n)
+        lat = np.empty(n)
+        for i, (node, data) in enumerate(G.nodes(data=True)):
+            x[i] = data['x']
+            y[i] = data['y']
+            lon[i] = data['lon']
+            lat[i] = data['lat']
+
+        m = G.number_of_edges()
+        u = np.empty(m, dtype=np.int64)
+        v = np.empty(m, dtype=np.int64)
+        weights = np.empty(m, dtype=np.float32)
+        lengths = np.empty(m, dtype=np.float32)
+        for i, (start, end, data) in enumerate(G.edges(data=True)):
+            u[i] = position[start]
+            v[i] = position[end]
+            weights[i] = data['travel_time']
+            lengths[i] = data['length']
+
+        indptr, indices, travel_time, length = compress_edges(n, u, v, weights, lengths)
+        return cls(node_ids, x, y, lon, lat, indptr, indices, travel_time, length, crs=G.graph.get('crs'))
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    # scipy sparse matrix view of the graph weighted by travel time
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = csr_matrix((self.travel_time, self.indices, self.indptr),
+                shape=(self.n_nodes, self.n_nodes))
+        return self._matrix
+
+    # scipy sparse matrix view of the graph weighted by length
+    @property
+    def length_matrix(self):
+        if self._length_matrix is None:
+            self._length_matrix = csr_matrix((self.length, self.indices, self.indptr),
+                shape=(self.n_nodes, self.n_nodes))
+        return self._length_matrix
+
+    # Returns the CSRGraph indices of a list of OSM node ids
+    def node_index(self, node_ids):
+        if self._sorted_ids is None:
+            self._sorted_ids = np.argsort(self.node_ids)
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        positions = np.searchsorted(self.node_ids, node_ids, sorter=self._sorted_ids)
+        positions = np.minimum(positions, self.n_nodes - 1)
+        index = self._sorted_ids[positions]
+        if not np.array_equal(self.node_ids[index], node_ids):
+            raise KeyError("Some node ids are not in the graph")
+        return index.astype(np.int32)
+
+    # Returns a (number of sources x number of nodes) float32 array holding the
+    # travel time (in seconds) from every source node to every node in the graph.
+    # Nodes that cannot be reached within `limit` seconds are set to infinity.
+    def arrival_times(self, sources, limit=np.inf, batch_size=BATCH_SIZE):
+        sources = np.asarray(sources, dtype=np.int32)
+        result = np.empty((len(sources), self.n_nodes), dtype=np.float32)
+        for start in range(0, len(sources), batch_size):
+            batch = sources[start:start + batch_size]
+            result[start:start + len(batch)] = dijkstra(self.matrix, directed=True,
+                indices=batch, limit=limit)
+        return result
+
+    # Runs a single multi-source search seeded from every source node at once.
+    # Returns two arrays with one entry per node in the graph:
+    # - the travel time (in seconds) from the closest source (infinity if unreached)
+    # - the position in `sources` of that closest source (-1 if unreached)
+    def first_due(self, sources, limit=np.inf):
+        sources = np.asarray(sources, dtype=np.int32)
+        arrival_times, _, closest = dijkstra(self.matrix, directed=True, indices=sources,
+            limit=limit, min_only=True, return_predecessors=True)
+
+        # Map the closest source node back to its position in `sources`. When several
+        # sources share a node, the first one in the list is used.
+        source_position = np.full(self.n_nodes, -1, dtype=np.int32)
+        source_position[sources[::-1]] = np.arange(len(sources) - 1, -1, -1, dtype=np.int32)
+        labels = np.where(closest >= 0, source_position[np.maximum(closest, 0)], -1)
+        return arrival_times.astype(np.float32), labels.astype(np.int32)
+
+    # Returns a NetworkX MultiDiGraph with the same nodes, coordinates, travel times and lengths,
+    # for the parts of the pipeline that still work on NetworkX graphs
+    def to_networkx(self):
+        G = nx.MultiDiGraph(crs=self.crs)
+        G.add_nodes_from((int(node), {'x': float(x), 'y': float(y), 'lon': float(lon), 'lat': float(lat)})
+            for node, x, y, lon, lat in zip(self.node_ids, self.x, self.y, self.lon, self.lat))
+        u = np.repeat(self.node_ids, np.diff(self.indptr))
+        v = self.node_ids[self.indices]
+        G.add_edges_from((int(start), int(end), {'travel_time': float(travel_time), 'length': float(length)})
+            for start, end, travel_time, length in zip(u, v, self.travel_time, self.length))
+        return G
+
+    # KD-tree over the projected node coordinates, built on first use
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(np.column_stack((self.x, self.y)))
+        return self._tree
+
+    # Snaps points (given in the graph's projected CRS) to their nearest nodes in a
+    # single vectorized query. Returns the CSRGraph indices of the nearest nodes and
+    # the distances (in meters) between the points and those nodes.
+    def snap(self, x, y):
+        distances, index = self.tree.query(np.column_stack((np.asarray(x), np.asarray(y))))
+        return index.astype(np.int32), distances
+
+    # Returns the travel time (in seconds) from a source node to every node in the graph,
+    # searching only through the nodes for which `allowed` is True. Nodes that are not
+    # allowed, or cannot be reached within `limit` seconds, are set to infinity.
+    def restricted_arrival_times(self, source, allowed, limit=np.inf):
+        allowed_nodes = np.flatnonzero(allowed)
+        submatrix = self.matrix[allowed_nodes][:, allowed_nodes]
+        local_source = np.searchsorted(allowed_nodes, source)
+        if local_source >= len(allowed_nodes) or allowed_nodes[local_source] != source:
+            raise ValueError("The source node is not one of the allowed nodes")
+
+        result = np.full(self.n_nodes, np.inf, dtype=np.float32)
+        result[allowed_nodes] = dijkstra(submatrix, directed=True, indices=local_source, limit=limit)
+        return result
+
+    # Returns a boolean array telling which nodes lie within (or on the boundary of) a shapely geometry
+    # (given in the graph's projected CRS)
+    def nodes_within(self, geometry):
+        min_x, min_y, max_x, max_y = geometry.bounds
+        inside = (self.x >= min_x) & (self.x <= max_x) & (self.y >= min_y) & (self.y <= max_y)
+        candidates = np.flatnonzero(inside)
+        points = gpd.GeoSeries(gpd.points_from_xy(self.x[candidates], self.y[candidates]))
+        inside[candidates] = points.intersects(geometry).values
+        return inside
+
+    # Runs a single multi-source search, measured in meters and ignoring the direction
+    # of the roads, seeded from every source node at once. Every source can start with a
+    # distance already covered (e.g. from a hydrant to its nearest node).
+    # Returns the distance (in meters) from the closest source to every node in the graph
+    # (infinity for the nodes that cannot be reached within `limit` meters).
+    def source_distances(self, sources, offsets=None, limit=np.inf):
+        sources = np.asarray(sources, dtype=np.int64)
+        if offsets is None:
+            offsets = np.zeros(len(sources))
+
+        # Connect a virtual node (index n_nodes) to every source, with the source's offset
+        # as the edge length. Sources sharing a node keep their smallest offset.
+        start = np.full(self.n_nodes, np.inf)
+        np.minimum.at(start, sources, np.asarray(offsets, dtype=np.float64))
+        seeded = np.flatnonzero(np.isfinite(start))
+        n = self.n_nodes
+        rows = np.concatenate([np.repeat(np.arange(n), np.diff(self.indptr)), np.full(len(seeded), n)])
+        columns = np.concatenate([self.indices, seeded])
+        lengths = np.concatenate([self.length, np.maximum(start[seeded], MIN_EDGE_WEIGHT)])
+        matrix = csr_matrix((lengths, (rows, columns)), shape=(n + 1, n + 1))
+
+        distances = dijkstra(matrix, directed=False, indices=n, limit=limit)
+        return distances[:n].astype(np.float32)
+
+    # Returns a ContractedGraph routing on a smaller copy of this graph, without its dead ends
+    # and the inner nodes of its road chains. The protected nodes (e.g. the stations the
+    # searches start from) are never removed.
+    def contract(self, protected=()):
+        return ContractedGraph(self, protected)
+
+
+# Routing graph derived from a CSRGraph by removing the nodes that cannot change which
+# nodes are reached first, only how long it takes to get to them:
+# - dead ends: trees of two-way roads hanging off the rest of the graph, peeled leaf by leaf
+# - road chains: runs of nodes with two neighbors, merged into a single edge between the
+#   nodes at both ends of the chain (summing its travel times and lengths)
+# Only nodes whose roads are all two-way are removed.
+#
+# The searches run on the contracted `core` graph. Every removed node is then reached
+# through one of its (at most two) anchors, the kept nodes at the ends of its chain or at
+# the root of its dead end, so its travel time is that of the best anchor plus the travel
+# time from that anchor along the chain. The results therefore have one entry per node of
+# the original graph, and polygons are still built from all of its nodes.
+class ContractedGraph:
+
+    def __init__(self, graph, protected=()):
+        self.graph = graph
+        n = graph.n_nodes
+        u = np.repeat(np.arange(n, dtype=np.int64), np.diff(graph.indptr))
+        v = graph.indices.astype(np.int64)
+
+        # Nodes with a one-way road (an edge without its reverse edge) are always kept
+        keys = u * n + v
+        reverse_keys = v * n + u
+        sorted_keys = np.sort(keys)
+        positions = np.minimum(np.searchsorted(sorted_keys, reverse_keys), len(keys) - 1)
+        two_way = sorted_keys[positions] == reverse_keys
+        removable = np.ones(n, dtype=bool)
+        removable[u[~two_way]] = False
+        removable[v[~two_way]] = False
+        removable[np.asarray(protected, dtype=np.int64)] = False
+
+        # Number of neighbors of every node that are still in the graph
+        degree = np.diff(graph.indptr).astype(np.int64)
+        removed = np.zeros(n, dtype=bool)
+
+        # Anchors of every removed node, and the travel time from each anchor to the node
+        # (through the removed nodes). Dead ends only have a first anchor.
+        first = np.full(n, -1, dtype=np.int64)
+        second = np.full(n, -1, dtype=np.int64)
+        from_first = np.full(n, np.inf)
+        from_second = np.full(n, np.inf)
+
+        # Peel the dead ends leaf by leaf. Every leaf is first attached to its parent, which
+        # may itself be removed later on, so the anchors are resolved in reverse order.
+        parents = []
+        leaves = list(np.flatnonzero(removable & (degree == 1)))
+        while leaves:
+            leaf = leaves.pop()
+            if removed[leaf] or degree[leaf] != 1:
+                continue
+            parent = next(neighbor for neighbor in self._neighbors(leaf) if not removed[neighbor])
+            removed[leaf] = True
+            degree[parent] -= 1
+            parents.append((leaf, parent, self._travel_time(parent, leaf)))
+            if removable[parent] and degree[parent] == 1:
+                leaves.append(parent)
+
+        # Merge the road chains: walk from every kept node through the removable nodes
+        # left with two neighbors, up to the kept node at the other end of the chain
+        in_chain = removable & ~removed & (degree == 2)
+        core_u, core_v, core_time, core_length = [], [], [], []
+        for start in np.flatnonzero(~removed & ~in_chain):
+            for neighbor in self._neighbors(start):
+                if removed[neighbor] or not in_chain[neighbor] or first[neighbor] >= 0:
+                    continue
+                chain = [start, neighbor]
+                while in_chain[chain[-1]]:
+                    chain.append(next(node for node in self._neighbors(chain[-1])
+                        if not removed[node] and node != chain[-2]))
+                end = chain[-1]
+
+                forward = np.cumsum([0] + [self._travel_time(a, b) for a, b in zip(chain[:-1], chain[1:])])
+                backward = np.cumsum([0] + [self._travel_time(b, a)
+                    for a, b in zip(chain[:-1], chain[1:])][::-1])[::-1]
+                length = sum(self._length(a, b) for a, b in zip(chain[:-1], chain[1:]))
+                inner = np.array(chain[1:-1])
+                first[inner], from_first[inner] = start, forward[1:-1]
+                second[inner], from_second[inner] = end, backward[1:-1]
+                core_u += [start, end]
+                core_v += [end, start]
+                core_time += [forward[-1], backward[0]]
+                core_length += [length, length]
+
+        # Chains closed on themselves without any kept node are left as they are
+        in_chain &= first >= 0
+        removed |= in_chain
+
+        for leaf, parent, travel_time in reversed(parents):
+            if removed[parent]:
+                first[leaf], from_first[leaf] = first[parent], from_first[parent] + travel_time
+                second[leaf], from_second[leaf] = second[parent], from_second[parent] + travel_time
+            else:
+                first[leaf], from_first[leaf] = parent, travel_time
+
+        # The core graph holds the kept nodes, the edges between them and the merged chains
+        self.kept = np.flatnonzero(~removed)
+        self.removed = np.flatnonzero(removed)
+        core_index = np.full(n, -1, dtype=np.int64)
+        core_index[self.kept] = np.arange(len(self.kept))
+        self.core_index = core_index
+        keep_edge = ~removed[u] & ~removed[v]
+        edge_u = np.concatenate([core_index[u[keep_edge]], core_index[np.array(core_u, dtype=np.int64)]])
+        edge_v = np.concatenate([core_index[v[keep_edge]], core_index[np.array(core_v, dtype=np.int64)]])
+        edge_time = np.concatenate([graph.travel_time[keep_edge], np.array(core_time, dtype=np.float32)])
+        edge_length = np.concatenate([graph.length[keep_edge], np.array(core_length, dtype=np.float32)])
+        indptr, indices, travel_time, length = compress_edges(len(self.kept), edge_u, edge_v,
+            edge_time, edge_length)
+        self.core = CSRGraph(graph.node_ids[self.kept], graph.x[self.kept], graph.y[self.kept],
+            graph.lon[self.kept], graph.lat[self.kept], indptr, indices, travel_time, length, graph.crs)
+
+        # Anchors of the removed nodes, as core indices (-1 for the missing second anchors)
+        self.first = core_index[first[self.removed]]
+        self.second = np.where(second[self.removed] >= 0, core_index[np.maximum(second[self.removed], 0)], -1)
+        self.from_first = from_first[self.removed]
+        self.from_second = from_second[self.removed]
+
+    @property
+    def n_nodes(self):
+        return self.graph.n_nodes
+
+    # Returns the neighbors of a node of the original graph
+    def _neighbors(self, node):
+        return self.graph.indices[self.graph.indptr[node]:self.graph.indptr[node + 1]]
+
+    # Returns the position in the CSR arrays of the edge from node a to node b
+    # (the targets of every node are sorted, see compress_edges)
+    def _edge(self, a, b):
+        start = self.graph.indptr[a]
+        return start + np.searchsorted(self.graph.indices[start:self.graph.indptr[a + 1]], b)
+
+    # Returns the travel time (in seconds) and the length (in meters) of the edge from node a to node b
+    def _travel_time(self, a, b):
+        return float(self.graph.travel_time[self._edge(a, b)])
+
+    def _length(self, a, b):
+        return float(self.graph.length[self._edge(a, b)])
+
+    # Returns the core indices of the given (kept) nodes of the original graph
+    def _core_sources(self, sources):
+        core_sources = self.core_index[np.asarray(sources, dtype=np.int64)]
+        if (core_sources < 0).any():
+            raise ValueError("Sources must be protected when contracting the graph")
+        return core_sources.astype(np.int32)
+
+    # Returns the travel times of the removed nodes given those of the core nodes (last axis),
+    # along with whether they were reached through their second anchor
+    def _removed_times(self, core_times):
+        through_first = core_times[..., self.first] + self.from_first
+        through_second = np.where(self.second >= 0,
+            core_times[..., np.maximum(self.second, 0)] + self.from_second, np.inf)
+        return np.minimum(through_first, through_second), through_second < through_first
+
+    # Same as CSRGraph.arrival_times(), with one column per node of the original graph
+    def arrival_times(self, sources, limit=np.inf, batch_size=BATCH_SIZE):
+        core_times = self.core.arrival_times(self._core_sources(sources), limit, batch_size)
+        result = np.empty((len(core_times), self.n_nodes), dtype=np.float32)
+        result[:, self.kept] = core_times
+        removed_times, _ = self._removed_times(core_times)
+        result[:, self.removed] = np.where(removed_times <= limit, removed_times, np.inf)
+        return result
+
+    # Same as CSRGraph.first_due(), with one entry per node of the original graph
+    def first_due(self, sources, limit=np.inf):
+        core_times, core_labels = self.core.first_due(self._core_sources(sources), limit)
+        arrival_times = np.empty(self.n_nodes, dtype=np.float32)
+        labels = np.empty(self.n_nodes, dtype=np.int32)
+        arrival_times[self.kept] = core_times
+        labels[self.kept] = core_labels
+
+        removed_times, through_second = self._removed_times(core_times)
+        reached = removed_times <= limit
+        arrival_times[self.removed] = np.where(reached, removed_times, np.inf)
+        anchor = np.where(through_second, self.second, self.first)
+        labels[self.removed] = np.where(reached, core_labels[anchor], -1)
+        return arrival_times, labels